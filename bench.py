@@ -0,0 +1,501 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Бенчмарки всегда идут в безголовом режиме: без окна, звука и ожидания таймера
+os.environ["PLATFORMER_HEADLESS"] = "1"
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import pygame as pg  # noqa: E402
+import pytmx  # noqa: E402
+
+import main2  # noqa: E402
+
+TILE_SIZE = 32
+SEED = 1234
+
+# Размеры карт в тайлах для замеров загрузки и отрисовки
+MAP_SIZES = [(100, 30), (400, 60), (1000, 100)]
+# (крабы, монеты, шары) для замеров симуляции
+ENTITY_COUNTS = [(0, 0, 0), (20, 100, 0), (100, 500, 10), (300, 2000, 40)]
+# Сколько экземпляров каждой сущности создаётся для отчёта о памяти
+MEMORY_ENTITY_COUNT = 2000
+# Регрессионные прогоны (colliders, spatial, swarm): (ширина, высота, крабы, зерно ввода) и число тиков.
+# Каждый прогон сравнивает положения после каждого тика на одном и том же вводе при двух настройках
+REGRESSION_MAPS = [(100, 30, 20, 1), (200, 40, 30, 2), (400, 60, 60, 3)]
+REGRESSION_WALLS = 8  # Столбов и ступеней на каждые 100 тайлов ширины
+REGRESSION_TICKS = 3000
+
+# Заглушки спрайтов на случай, если в рабочей копии нет папки sprites: путь -> (ширина, высота)
+PLACEHOLDER_SPRITES = {
+    "sprites/Sprite Pack 3/2 - Twiggy/Idle (32 x 32).png": (5 * 32, 32),
+    "sprites/Sprite Pack 3/2 - Twiggy/Running (32 x 32).png": (6 * 32, 32),
+    "sprites/Sprite Pack 2/9 - Snip Snap Crab/Movement_(Flip_image_back_and_forth) (32 x 32).png": (32, 32),
+    "sprites/Sprite Pack 2/4 - Robo Pumpkin/Standing (16 x 16).png": (16, 16),
+    "sprites/ball.png": (16, 16),
+    "sprites/spr_coin_strip4.png": (4 * 16, 16),
+    "sprites/Green Portal Sprite Sheet.png": (8 * 64, 64),
+}
+
+
+def prepare_workdir(workdir):
+    # Рабочая папка с ресурсами игры: фоны из репозитория, спрайты — настоящие или заглушки
+    for name in ("Background.png", "menu.jpg"):
+        shutil.copy(os.path.join(ROOT, name), workdir)
+    if os.path.isdir(os.path.join(ROOT, "sprites")):
+        shutil.copytree(os.path.join(ROOT, "sprites"), os.path.join(workdir, "sprites"))
+    else:
+        for path, size in PLACEHOLDER_SPRITES.items():
+            image = pg.Surface(size, pg.SRCALPHA)
+            image.fill((200, 60, 60, 255))
+            pg.draw.rect(image, (0, 0, 0, 0), (0, 0, size[0] // 4, size[1] // 4))
+            os.makedirs(os.path.dirname(os.path.join(workdir, path)), exist_ok=True)
+            pg.image.save(image, os.path.join(workdir, path))
+    os.makedirs(os.path.join(workdir, "maps"), exist_ok=True)
+    tileset = pg.Surface((2 * TILE_SIZE, TILE_SIZE))
+    tileset.fill((90, 60, 30), (0, 0, TILE_SIZE, TILE_SIZE))
+    tileset.fill((230, 230, 230), (TILE_SIZE, 0, TILE_SIZE, TILE_SIZE))
+    pg.image.save(tileset, os.path.join(workdir, "maps", "tiles.png"))
+
+
+def generate_map(workdir, width, height, crabs=0, coins=0, seed=SEED, walls=0):
+    # Процедурная карта: пол в два тайла, случайные полки, монеты над полом и портал в конце;
+    # walls — столбы и ступени от пола (углы и стыки для проверки столкновений).
+    # Пишет maps/level1.tmx и maps/level1_enemies.json, возвращает путь к TMX
+    rng = random.Random(seed)
+    ground = height - 2
+    game = [[0] * width for _ in range(height)]
+    for y in range(ground, height):
+        game[y] = [1] * width
+    for _ in range(width * height // 40):
+        x = rng.randrange(width - 8)
+        y = rng.randrange(2, ground - 3)
+        for dx in range(rng.randrange(2, 8)):
+            game[y][x + dx] = 1
+    for _ in range(walls):
+        x = rng.randrange(2, width - 8)
+        for step in range(rng.randrange(1, 4)):
+            for y in range(ground - rng.randrange(1, 5), ground):
+                game[y][x + step] = 1
+
+    coin_layer = [[0] * width for _ in range(height)]
+    for _ in range(coins):
+        coin_layer[rng.randrange(ground - 6, ground)][rng.randrange(width)] = 2
+
+    portal_layer = [[0] * width for _ in range(height)]
+    portal_layer[ground][width - 3] = 2
+
+    def layer(layer_id, name, rows):
+        data = ",\n".join(",".join(str(gid) for gid in row) for row in rows)
+        return (f'<layer id="{layer_id}" name="{name}" width="{width}" height="{height}">'
+                f'<data encoding="csv">\n{data}\n</data></layer>')
+
+    tmx = (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<map version="1.10" orientation="orthogonal" renderorder="right-down" width="{width}" '
+           f'height="{height}" tilewidth="{TILE_SIZE}" tileheight="{TILE_SIZE}" infinite="0">\n'
+           f'<tileset firstgid="1" name="bench" tilewidth="{TILE_SIZE}" tileheight="{TILE_SIZE}" tilecount="2" '
+           f'columns="2"><image source="tiles.png" width="{2 * TILE_SIZE}" height="{TILE_SIZE}"/></tileset>\n'
+           f'{layer(1, "Game", game)}\n{layer(2, "Coins", coin_layer)}\n{layer(3, "Portals", portal_layer)}\n'
+           f'</map>\n')
+    path = os.path.join(workdir, "maps", "level1.tmx")
+    with open(path, "w") as tmx_file:
+        tmx_file.write(tmx)
+
+    enemies = []
+    for _ in range(crabs):
+        x = rng.randrange(10, width - 10)
+        enemies.append({"name": "Crab", "start_pos": [x, ground], "final_pos": [x + 5, ground]})
+    with open(os.path.join(workdir, "maps", "level1_enemies.json"), "w") as json_file:
+        json.dump({"enemies": enemies}, json_file)
+    return path
+
+
+def measure(function, repeat):
+    # Время каждого повтора в миллисекундах
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def result(name, params, samples, unit_count=1):
+    # unit_count — сколько кадров/операций в одном повторе (для времени на единицу)
+    return {
+        "name": name,
+        "params": params,
+        "repeat": len(samples),
+        "median_ms": statistics.median(samples) / unit_count,
+        "mean_ms": statistics.fmean(samples) / unit_count,
+        "min_ms": min(samples) / unit_count,
+    }
+
+
+def new_game():
+    game = main2.Game(headless=True)
+    game.setup()
+    game.player.hp = 10 ** 9  # Игрок не должен проиграть посреди замера
+    return game
+
+
+def bench_load(workdir, repeat):
+    results = []
+    for width, height in MAP_SIZES:
+        path = generate_map(workdir, width, height, crabs=width // 10, coins=width)
+        params = {"width": width, "height": height}
+
+        def cold_setup():
+            # Без скомпилированного кэша: разбор TMX, компиляция и загрузка
+            shutil.rmtree(os.path.join(workdir, main2.LEVEL_CACHE_DIR), ignore_errors=True)
+            new_game()
+
+        def parse():
+            # Разбор TMX так же, как при компиляции уровня: без загрузки картинок
+            return pytmx.TiledMap(path, image_loader=main2.tile_source_loader)
+
+        results.append(result("load.parse", params, measure(parse, repeat)))
+        results.append(result("load.setup_cold", params, measure(cold_setup, repeat)))
+        results.append(result("load.setup", params, measure(new_game, repeat)))
+    return results
+
+
+def bench_update(workdir, repeat, frames):
+    results = []
+    for crabs, coins, balls in ENTITY_COUNTS:
+        generate_map(workdir, 400, 30, crabs=crabs, coins=coins)
+        game = new_game()
+
+        def run_frames():
+            for _ in range(frames):
+                # Поддерживаем нужное число шаров в полёте
+                for _ in range(balls - len(game.balls)):
+                    game.balls.spawn(game.player.rect, "right")
+                game.simulate(1)
+
+        params = {"crabs": crabs, "coins": coins, "balls": balls, "frames": frames}
+        results.append(result("update.frame", params, measure(run_frames, repeat), frames))
+    return results
+
+
+def bench_draw(workdir, repeat, frames):
+    results = []
+    for width, height in MAP_SIZES:
+        generate_map(workdir, width, height, crabs=width // 10, coins=width)
+        game = new_game()
+        max_x = max(0, game.map_pixel_width - main2.SCREEN_WIDTH)
+        max_y = max(0, game.map_pixel_height - main2.SCREEN_HEIGHT)
+
+        counts = []  # (нарисовано, отсечено) на каждый кадр всех повторов
+
+        def draw_frames():
+            # Камера проходит карту по диагонали, чтобы задействовать сборку и вытеснение чанков
+            for frame in range(frames):
+                game.camera_x = max_x * frame / frames
+                game.camera_y = max_y * frame / frames
+                game.save_positions()
+                game.draw()
+                counts.append((game.sprites_drawn, game.sprites_culled))
+
+        params = {"width": width, "height": height, "frames": frames}
+        item = result("draw.frame", params, measure(draw_frames, repeat), frames)
+        item["sprites_drawn"] = statistics.fmean(drawn for drawn, _ in counts)
+        item["sprites_culled"] = statistics.fmean(culled for _, culled in counts)
+        results.append(item)
+    return results
+
+
+def random_controls(seed, ticks):
+    # Воспроизводимый ввод: направление держится по нескольку секунд, прыжки и выстрелы — случайно
+    rng = random.Random(seed)
+    held = 0
+    controls = []
+    for _ in range(ticks):
+        if rng.random() < 0.02:
+            held = rng.choice([0, main2.INPUT_LEFT, main2.INPUT_RIGHT])
+        jump = main2.INPUT_JUMP if rng.random() < 0.05 else 0
+        fire = main2.INPUT_FIRE if rng.random() < 0.02 else 0
+        controls.append(held | jump | fire)
+    return controls
+
+
+class LinearPlatforms:
+    # Полный перебор коллайдеров в порядке вставки — то, что заменила сетка (SpatialHash.scan/query)
+    def __init__(self, platforms):
+        self.platforms = list(platforms)
+
+    def scan(self, rect, margin=0):
+        return iter(self.platforms)
+
+    def query(self, rect, margin=0):
+        return list(self.platforms)
+
+
+def input_trace(controls, settings=None, configure=None):
+    # Положения игрока и врагов после каждого тика на одном и том же вводе.
+    # settings — значения модульных настроек main2 на время прогона, configure(game) — правка игры после setup.
+    # Спящий враг записывается как None: его rect не обновляется до пробуждения
+    settings = settings or {}
+    saved = {name: getattr(main2, name) for name in settings}
+    for name, value in settings.items():
+        setattr(main2, name, value)
+    try:
+        game = new_game()
+        if configure is not None:
+            configure(game)
+        game.portals.empty()  # Портал сменил бы уровень посреди сравнения
+        game.replay = controls + [0]  # Лишний тик: на последнем тике записи игра останавливается
+        game.replay_position = 0
+        trace = []
+        for _ in controls:
+            game.simulate(1)
+            enemies = [enemy.rect.topleft if enemy in game.movers else None for enemy in game.enemies]
+            trace.append((game.player.rect.topleft, enemies))
+    finally:
+        for name, value in saved.items():
+            setattr(main2, name, value)
+    return game, trace
+
+
+def trace_diff(first, second):
+    # Тики, на которых положения разошлись; спящие враги (None) не сравниваются
+    def same(a, b):
+        return len(a) == len(b) and all(x is None or y is None or x == y for x, y in zip(a, b))
+
+    pairs = list(enumerate(zip(first, second)))
+    player = [tick for tick, (a, b) in pairs if a[0] != b[0]]
+    enemies = [tick for tick, (a, b) in pairs if not same(a[1], b[1])]
+    return {
+        "player_mismatches": len(player),
+        "enemy_mismatches": len(enemies),
+        "first_mismatch": min(player[:1] + enemies[:1], default=None),
+    }
+
+
+def regression_maps(workdir):
+    # Карты и ввод регрессионных прогонов: (параметры для отчёта, ввод)
+    for width, height, crabs, seed in REGRESSION_MAPS:
+        generate_map(workdir, width, height, crabs=crabs, walls=width * REGRESSION_WALLS // 100)
+        params = {"width": width, "height": height, "crabs": crabs, "seed": seed, "ticks": REGRESSION_TICKS}
+        yield params, random_controls(seed, REGRESSION_TICKS)
+
+
+def bench_colliders(workdir):
+    # Регрессионный прогон: объединённые прямоугольники столкновений против коллайдера на каждый тайл.
+    # На углах и стыках объединённых прямоугольников выталкивание может отличаться (см. merge_solid_tiles),
+    # здесь видно, насколько часто это меняет положения на одном и том же вводе
+    results = []
+    for params, controls in regression_maps(workdir):
+        merged_game, merged = input_trace(controls, {"MERGED_COLLIDERS": True})
+        tile_game, tiles = input_trace(controls, {"MERGED_COLLIDERS": False})
+        results.append({
+            "name": "colliders.diff",
+            "params": params,
+            "colliders": len(merged_game.platforms),
+            "tile_colliders": len(tile_game.platforms),
+            **trace_diff(merged, tiles),
+        })
+    return results
+
+
+def bench_spatial(workdir):
+    # Регрессионный прогон: столкновения игрока и крабов через сетку (SpatialHash.scan) против полного
+    # перебора коллайдеров. Результат должен совпадать тик в тик. Враги обновляются по одному и не спят,
+    # чтобы через scan прошли столкновения каждого краба на каждом тике
+    settings = {"BATCHED_ENEMIES": False, "ACTIVATION_MARGIN": -1}
+    results = []
+    for params, controls in regression_maps(workdir):
+        _, grid = input_trace(controls, settings)
+        _, linear = input_trace(controls, settings,
+                                lambda game: setattr(game, "platform_index", LinearPlatforms(game.platform_index)))
+        results.append({"name": "spatial.diff", "params": params, **trace_diff(grid, linear)})
+    return results
+
+
+def bench_swarm(workdir):
+    # Регрессионный прогон врагов: пакетное обновление (EnemySwarm) против обновления по одному
+    # (PLATFORMER_BATCHED_ENEMIES=0) при всех бодрствующих врагах, и сон за пределами ACTIVATION_MARGIN
+    # против ACTIVATION_MARGIN=-1. Проснувшийся враг должен оказаться там же, где был бы без сна
+    awake = {"ACTIVATION_MARGIN": -1}
+    results = []
+    for params, controls in regression_maps(workdir):
+        _, reference = input_trace(controls, awake)
+        if main2.np is not None and main2.BATCHED_ENEMIES:  # Иначе пакетного обновления нет, сравнивать не с чем
+            _, single = input_trace(controls, {"BATCHED_ENEMIES": False, **awake})
+            results.append({"name": "swarm.batched.diff", "params": params, **trace_diff(reference, single)})
+        _, sleeping = input_trace(controls)
+        results.append({
+            "name": "swarm.sleep.diff",
+            "params": {**params, "margin": main2.ACTIVATION_MARGIN},
+            **trace_diff(sleeping, reference),
+        })
+    return results
+
+
+def allocated_bytes(build, count):
+    # Память Python-объектов, которую занимают count экземпляров, на один экземпляр
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return (after - before) / count
+
+
+def legacy_entity(entity, class_attributes=()):
+    # Прежнее представление: спрайт, у которого все атрибуты, включая кадры анимации,
+    # гравитацию и интервалы (теперь общие для класса), лежат в собственном __dict__
+    legacy = pg.sprite.Sprite()
+    legacy.__dict__.update({name: value.copy() if isinstance(value, pg.Rect) else value
+                            for name, value in main2.entity_state(entity).items()})
+    for name in class_attributes:
+        legacy.__dict__[name] = getattr(entity, name)
+    return legacy
+
+
+def legacy_ship(ship, image):
+    # Прежний шип: отдельный спрайт со своей увеличенной копией тайла и своей маской
+    legacy = pg.sprite.Sprite()
+    legacy.image = pg.transform.scale(image, ship.rect.size)
+    legacy.mask = pg.mask.from_surface(legacy.image)
+    legacy.rect = ship.rect.copy()
+    return legacy
+
+
+def bench_memory(workdir):
+    # Отчёт о памяти на одну сущность: текущие классы против прежнего представления на __dict__.
+    # Пиксели поверхностей tracemalloc не видит, поэтому для шипов они посчитаны отдельно
+    generate_map(workdir, 100, 30)
+    game = new_game()
+    width, height = game.map_pixel_width, game.map_pixel_height
+    tile = game.level_data.tile_images[1]
+    mask = pg.mask.from_surface(tile)
+    count = MEMORY_ENTITY_COUNT
+
+    entities = {
+        "Coin": (lambda i: main2.Coin(i, 0), ("images",)),
+        "Crab": (lambda i: main2.Crab(width, height, [i, 0], [i + 100, 0]), ("animation", "gravity", "interval")),
+        "Collider": (lambda i: main2.Collider(i, 0, 16, 16), ()),
+    }
+    results = []
+    for name, (build, class_attributes) in entities.items():
+        samples = [build(i) for i in range(count)]
+        results.append({
+            "name": "memory.entity",
+            "params": {"entity": name, "count": count},
+            "bytes_per_entity": allocated_bytes(build, count),
+            "legacy_bytes_per_entity": allocated_bytes(lambda i: legacy_entity(samples[i], class_attributes), count),
+        })
+
+    ships = [main2.Ship(mask, i, 0, *tile.get_size()) for i in range(count)]
+    ship_pixels = ships[0].rect.width * ships[0].rect.height
+    results.append({
+        "name": "memory.entity",
+        "params": {"entity": "Ship", "count": count},
+        "bytes_per_entity": allocated_bytes(lambda i: main2.Ship(mask, i, 0, *tile.get_size()), count),
+        "legacy_bytes_per_entity": allocated_bytes(lambda i: legacy_ship(ships[i], tile), count),
+        # Своя копия тайла (4 байта на пиксель) и маска (бит на пиксель) у каждого прежнего шипа
+        "legacy_surface_bytes_per_entity": ship_pixels * 4 + ship_pixels // 8,
+    })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    # Сравнение с прошлым прогоном: возвращает список замедлившихся замеров
+    with open(baseline_path) as baseline_file:
+        baseline = {(item["name"], json.dumps(item["params"], sort_keys=True)): item
+                    for item in json.load(baseline_file)["results"]}
+    regressions = []
+    for item in results:
+        old = baseline.get((item["name"], json.dumps(item["params"], sort_keys=True)))
+        # Замеры времени сравниваются по медиане, отчёт о памяти — по байтам на сущность
+        metric, unit = ("median_ms", "ms") if "median_ms" in item else ("bytes_per_entity", "B")
+        if old is None or not old.get(metric):
+            continue
+        ratio = item[metric] / old[metric]
+        print(f"{item['name']:14} {json.dumps(item['params'], sort_keys=True):60} "
+              f"{old[metric]:9.3f} -> {item[metric]:9.3f} {unit}  x{ratio:.2f}", file=sys.stderr)
+        if ratio > threshold:
+            regressions.append(item)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки загрузки карт, физики и отрисовки")
+    parser.add_argument("--only", choices=["load", "update", "draw", "memory", "colliders", "spatial", "swarm"], action="append",
+                        help="запустить только указанные группы (можно несколько раз)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--output", help="куда записать JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="во сколько раз медиана может вырасти, не считаясь регрессией")
+    args = parser.parse_args()
+    groups = args.only or ["load", "update", "draw", "memory", "colliders", "spatial", "swarm"]
+
+    workdir = tempfile.mkdtemp(prefix="platformer-bench-")
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        # pytmx конвертирует тайлы под формат экрана, поэтому окно (dummy) нужно ещё до первой игры
+        pg.display.set_mode((main2.SCREEN_WIDTH, main2.SCREEN_HEIGHT))
+        prepare_workdir(workdir)
+        results = []
+        if "load" in groups:
+            results += bench_load(workdir, args.repeat)
+        if "update" in groups:
+            results += bench_update(workdir, args.repeat, args.frames)
+        if "draw" in groups:
+            results += bench_draw(workdir, args.repeat, args.frames)
+        if "memory" in groups:
+            results += bench_memory(workdir)
+        if "colliders" in groups:
+            results += bench_colliders(workdir)
+        if "spatial" in groups:
+            results += bench_spatial(workdir)
+        if "swarm" in groups:
+            results += bench_swarm(workdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "seed": SEED,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
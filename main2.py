@@ -1,16 +1,44 @@
+import csv
+import hashlib
 import json
+import mmap
+import os
+import struct
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import pygame as pg
 import pygame.mixer
 import pytmx
+from pytmx.util_pygame import handle_transformation
+
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: без него враги обновляются по одному
+    np = None
+
+# Безголовый режим: без окна и звука, симуляция идёт так быстро, как позволяет процессор
+# (прогон уровней для балансировки и CI). Драйверы SDL нужно выбрать до pg.init()
+HEADLESS = os.environ.get("PLATFORMER_HEADLESS") == "1"
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
 
 pg.init()
 
 SCREEN_WIDTH = 1680
 SCREEN_HEIGHT = 1050
-FPS = 80
+FPS = 0  # Ограничение частоты отрисовки; 0 — рисовать так быстро, как позволяет дисплей
 TILE_SCALE = 2
 
+# Симуляция идёт фиксированными шагами, все скорости ниже заданы "за тик"
+TICK_RATE = 80
+TICK_MS = 1000 / TICK_RATE
+MAX_FRAME_TIME = 250  # Больше этого за один кадр не догоняем (окно перетаскивали, отладчик и т.п.)
+
 GRAVITY = 2
 MOVE_SPEED = 10
 JUMP_SPEED = -40
@@ -18,84 +46,551 @@ MAX_FALL_SPEED = 20
 
 font = pg.font.Font(None, 36)
 
-pygame.mixer.music.load("C:/Users/timur/Documents/pythonProject/Platformer/music 2.mp3")
-pygame.mixer.music.set_volume(0.1)
+MUSIC_PATH = "music 2.mp3"
+
+# Ввод за один тик упаковывается в байт из этих флагов
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_FIRE = 8  # Enter нажат с прошлого тика
+INPUT_ANY_KEY = 16  # Любая клавиша нажата с прошлого тика (рестарт после проигрыша)
+
+# Запись ввода: заголовок (метка, версия, уровень, число тиков) и пары (байт ввода, длина повтора)
+INPUT_LOG_MAGIC = b"PLRP"
+INPUT_LOG_VERSION = 1
+INPUT_LOG_HEADER = struct.Struct("<4sBHI")
+INPUT_LOG_RUN = struct.Struct("<BH")
+
+
+def read_keyboard():
+    # Удерживаемые клавиши движения в виде флагов ввода
+    keys = pg.key.get_pressed()
+    controls = 0
+    if keys[pg.K_a]:
+        controls |= INPUT_LEFT
+    if keys[pg.K_d]:
+        controls |= INPUT_RIGHT
+    if keys[pg.K_SPACE]:
+        controls |= INPUT_JUMP
+    return controls
+
+
+def save_input_log(path, level, frames):
+    data = bytearray(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, level, len(frames)))
+    position = 0
+    while position < len(frames):
+        value = frames[position]
+        run = 1
+        while position + run < len(frames) and frames[position + run] == value and run < 0xFFFF:
+            run += 1
+        data += INPUT_LOG_RUN.pack(value, run)
+        position += run
+    with open(path, "wb") as log_file:
+        log_file.write(data)
+
+
+def load_input_log(path):
+    # Возвращает (уровень, bytes с вводом по тикам)
+    with open(path, "rb") as log_file:
+        data = log_file.read()
+    magic, version, level, count = INPUT_LOG_HEADER.unpack_from(data)
+    if magic != INPUT_LOG_MAGIC or version != INPUT_LOG_VERSION:
+        raise ValueError(f"{path}: не запись ввода платформера")
+    frames = bytearray()
+    for value, run in INPUT_LOG_RUN.iter_unpack(data[INPUT_LOG_HEADER.size:]):
+        frames += bytes((value,)) * run
+    if len(frames) != count:
+        raise ValueError(f"{path}: запись повреждена ({len(frames)} тиков вместо {count})")
+    return level, bytes(frames)
+
+
+# Время симуляции: растёт только вместе с тиками, поэтому анимация и таймеры урона
+# не зависят от скорости машины и одинаково ведут себя при воспроизведении записи
+class SimulationClock:
+    def __init__(self):
+        self.tick = 0
+
+    def advance(self):
+        self.tick += 1
+
+    def reset(self):
+        self.tick = 0
+
+    def get_ticks(self):
+        return int(self.tick * TICK_MS)
+
+
+sim_clock = SimulationClock()
+
+
+# Общие часы анимации: тик симуляции читается один раз за тик, а кадр любого объекта
+# считается из этой фазы. У объектов с одной анимацией кадры меняются одновременно,
+# своих таймеров у них нет, и при воспроизведении записи кадры совпадают тик в тик
+class AnimationClock:
+    def __init__(self):
+        self.tick = 0
+        self.periods = {}  # интервал, мс -> длительность кадра в тиках
+
+    def sync(self, tick):
+        self.tick = tick
+
+    def period(self, interval):
+        # Кадр сменяется, когда по часам симуляции прошло строго больше interval мс
+        period = self.periods.get(interval)
+        if period is None:
+            period = 1
+            while int(period * TICK_MS) <= interval:
+                period += 1
+            self.periods[interval] = period
+        return period
+
+    def step(self, interval):
+        # Сколько раз кадр успел смениться с начала уровня
+        return self.tick // self.period(interval)
+
+    def frame(self, animation, interval, start=0):
+        # start — шаг, с которого анимация идёт с первого кадра
+        return animation[(self.step(interval) - start) % len(animation)]
+
+
+animation_clock = AnimationClock()
+
+
+# Замеры времени по фазам кадра. История хранится в кольцевом буфере,
+# по ней считаются p50/p95/p99 для оверлея (F3) и выгрузки в CSV/JSON (F4)
+class FrameProfiler:
+    HISTORY = 600  # Кадров в истории
+    OVERLAY_REFRESH = 30  # Раз во сколько кадров пересчитывать текст оверлея
+    DUMP_PATH = "profile.csv"
+
+    def __init__(self, history=HISTORY):
+        self.enabled = False
+        self.show_overlay = False
+        self.history = deque(maxlen=history)  # {фаза: мс, счётчик: значение} на каждый кадр
+        self.phases = []  # Фазы в порядке первого появления
+        self.counters = []  # Счётчики кадра (не время) в порядке первого появления
+        self.current = {}
+        self.frame_start = 0
+        self.overlay = []
+        self.overlay_countdown = 0
+
+    def begin_frame(self):
+        if self.enabled:
+            self.current = {}
+            self.frame_start = time.perf_counter()
+
+    def add(self, phase, seconds):
+        if self.enabled:
+            self.current[phase] = self.current.get(phase, 0) + seconds * 1000
+
+    def count(self, name, value):
+        # Значение счётчика за текущий кадр (например, сколько спрайтов нарисовано)
+        if self.enabled:
+            self.current[name] = value
+            if name not in self.counters:
+                self.counters.append(name)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.current["frame"] = (time.perf_counter() - self.frame_start) * 1000
+        for phase in self.current:
+            if phase not in self.phases and phase not in self.counters:
+                self.phases.append(phase)
+        self.history.append(self.current)
+
+    def percentiles(self, phase="frame"):
+        values = sorted(frame.get(phase, 0) for frame in self.history)
+        if not values:
+            return 0, 0, 0
+        return tuple(values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.95, 0.99))
+
+    def draw(self, screen):
+        # Текст пересчитывается раз в OVERLAY_REFRESH кадров, между пересчётами рисуются готовые поверхности
+        if self.overlay_countdown <= 0:
+            self.overlay = []
+            for phase in ["frame"] + [phase for phase in self.phases if phase != "frame"]:
+                p50, p95, p99 = self.percentiles(phase)
+                line = f"{phase}: p50 {p50:.2f}  p95 {p95:.2f}  p99 {p99:.2f} ms"
+                self.overlay.append(prepare_surface(font.render(line, True, "black", "white")))
+            for counter in self.counters:
+                p50, p95, p99 = self.percentiles(counter)
+                last = self.history[-1].get(counter, 0) if self.history else 0
+                line = f"{counter}: {last}  p50 {p50}  p95 {p95}  p99 {p99}"
+                self.overlay.append(prepare_surface(font.render(line, True, "black", "white")))
+            self.overlay_countdown = self.OVERLAY_REFRESH
+        self.overlay_countdown -= 1
+
+        y = 10
+        for text in self.overlay:
+            screen.blit(text, (screen.get_width() - text.get_width() - 10, y))
+            y += text.get_height()
+
+    def dump(self, path=DUMP_PATH):
+        # Формат выбирается по расширению: .json или CSV
+        if path.endswith(".json"):
+            with open(path, "w") as dump_file:
+                json.dump({"phases": self.phases, "counters": self.counters, "frames": list(self.history)}, dump_file)
+        else:
+            with open(path, "w", newline="") as dump_file:
+                fieldnames = ["frame"] + [phase for phase in self.phases if phase != "frame"] + self.counters
+                writer = csv.DictWriter(dump_file, fieldnames=fieldnames, restval=0)
+                writer.writeheader()
+                writer.writerows(self.history)
+
+
+profiler = FrameProfiler()
+
+
+# Все загруженные поверхности один раз переводятся в формат экрана, чтобы SDL
+# не конвертировал их при каждом blit. PLATFORMER_ASSET_CHECKS=1 включает проверку
+# в Game.draw (и на экранах меню и загрузки), что на экран не попадает ни одной неподготовленной поверхности
+RLE_MIN_TRANSPARENT = 0.25  # Доля прозрачных пикселей, с которой включается RLE-ускорение
+ASSET_CHECKS = os.environ.get("PLATFORMER_ASSET_CHECKS") == "1"
+# Режим "грязных прямоугольников": пока камера стоит, обновляются только изменившиеся области экрана
+DIRTY_RECTS = os.environ.get("PLATFORMER_DIRTY_RECTS") == "1"
+# Враги дальше этого расстояния (px) от краёв камеры засыпают; отрицательное значение отключает сон
+ACTIVATION_MARGIN = int(os.environ.get("PLATFORMER_ACTIVATION_MARGIN", "640"))
+# Пакетное обновление врагов на NumPy; PLATFORMER_BATCHED_ENEMIES=0 возвращает обновление по одному
+BATCHED_ENEMIES = np is not None and os.environ.get("PLATFORMER_BATCHED_ENEMIES", "1") == "1"
+# Объединённые прямоугольники столкновений; PLATFORMER_MERGED_COLLIDERS=0 возвращает коллайдер на каждый тайл
+# (для сравнения поведения, см. группу colliders в bench.py)
+MERGED_COLLIDERS = os.environ.get("PLATFORMER_MERGED_COLLIDERS", "1") == "1"
+
+
+def prepare_surface(surface, transparent_fraction=None):
+    # convert() для непрозрачных и colorkey-поверхностей, convert_alpha() для поверхностей
+    # с попиксельной прозрачностью; RLE — если прозрачных пикселей достаточно много.
+    # transparent_fraction — заранее известная (хотя бы нижняя) оценка доли прозрачного,
+    # чтобы не считать маску по всей поверхности
+    area = surface.get_width() * surface.get_height()
+    colorkey = surface.get_colorkey()
+    if colorkey is not None:
+        surface = surface.convert()
+        if area and (area - pg.mask.from_surface(surface).count()) / area >= RLE_MIN_TRANSPARENT:
+            surface.set_colorkey(colorkey, pg.RLEACCEL)
+        return surface
+    if surface.get_flags() & pg.SRCALPHA:
+        if transparent_fraction is None:
+            transparent_fraction = 1 - pg.mask.from_surface(surface, 254).count() / area if area else 0
+            keep_alpha = transparent_fraction > 0
+        else:
+            keep_alpha = True  # Оценка снизу: прозрачные пиксели могут быть и внутри самих тайлов
+        if keep_alpha:
+            surface = surface.convert_alpha()
+            if transparent_fraction >= RLE_MIN_TRANSPARENT:
+                surface.set_alpha(255, pg.RLEACCEL)
+            return surface
+    return surface.convert()
+
+
+def display_formats():
+    # Маски каналов экрана: (без прозрачности, с попиксельной прозрачностью)
+    return (pg.display.get_surface().get_masks(),
+            pg.Surface((1, 1), pg.SRCALPHA).convert_alpha().get_masks())
+
 
+def is_display_format(surface, formats):
+    opaque_masks, alpha_masks = formats
+    return surface.get_masks() == (alpha_masks if surface.get_flags() & pg.SRCALPHA else opaque_masks)
 
 
-class Player(pg.sprite.Sprite):
+# Декодирование картинок в пуле потоков. Поток только читает и распаковывает файл в программную
+# поверхность — обычный буфер пикселей в памяти, не связанный с экраном; перевод в формат экрана
+# (prepare_surface, convert_alpha) и всё остальное с поверхностями делается в главном потоке
+class AssetLoader:
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asset-decode")
+        self.futures = {}  # путь -> Future с декодированной поверхностью
+
+    def request(self, path, load=None):
+        # load(path) выполняется в пуле; по умолчанию — декодирование файла
+        future = self.futures.get(path)
+        if future is None:
+            future = self.futures[path] = self.executor.submit(load or pg.image.load, path)
+        return future
+
+    def load(self, path):
+        # Декодированная поверхность; если её не заказывали — декодируем сразу
+        future = self.futures.pop(path, None)
+        return future.result() if future is not None else pg.image.load(path)
+
+    def discard(self):
+        # Заказанное, но так и не понадобившееся
+        self.futures.clear()
+
+
+asset_loader = AssetLoader()
+
+
+# Общий кэш кадров анимации на весь процесс.
+# Каждый лист загружается, нарезается, масштабируется и отражается ровно один раз,
+# а все экземпляры получают одни и те же неизменяемые кортежи кадров.
+# Вместе с кадрами хранятся их маски для попиксельных столкновений.
+class FrameCache:
+    def __init__(self):
+        self.frames = {}
+        self.masks = {}  # кадр -> маска
+        self.last_used = {}  # ключ -> поколение (номер загрузки уровня), в котором кадры последний раз запрашивались
+        self.generation = 0
+
+    def get(self, key, build):
+        frames = self.frames.get(key)
+        if frames is None:
+            frames = build()
+            self.frames[key] = frames
+            for image in frames if isinstance(frames, tuple) else (frames,):
+                if image not in self.masks:
+                    self.masks[image] = pg.mask.from_surface(image)
+        self.last_used[key] = self.generation
+        return frames
+
+    def strip(self, path, frame_size, num_frames, scale, flip=False):
+        # Горизонтальная полоска кадров одинакового размера
+        if flip:
+            right = self.strip(path, frame_size, num_frames, scale)
+            return self.get(("strip", path, frame_size, num_frames, scale, True),
+                            lambda: tuple(prepare_surface(pg.transform.flip(image, True, False)) for image in right))
+
+        def build():
+            spritesheet = asset_loader.load(path)
+            size = (frame_size[0] * scale, frame_size[1] * scale)
+            return tuple(
+                prepare_surface(pg.transform.scale(
+                    spritesheet.subsurface((i * frame_size[0], 0, frame_size[0], frame_size[1])), size))
+                for i in range(num_frames))
+
+        return self.get(("strip", path, frame_size, num_frames, scale, False), build)
+
+    def image(self, path, size):
+        # Целое изображение, приведённое к нужному размеру
+        return self.get(("image", path, size),
+                        lambda: prepare_surface(pg.transform.scale(asset_loader.load(path), size)))
+
+    def mirrored(self, path, size):
+        # Изображение и его зеркальная копия (анимация "туда-обратно")
+        image = self.image(path, size)
+        return self.get(("mirrored", path, size),
+                        lambda: (image, prepare_surface(pg.transform.flip(image, True, False))))
+
+    def begin_level(self):
+        # Вытесняем кадры, которые не понадобились за весь предыдущий уровень.
+        # Кадры прошедшего уровня оставляем: скорее всего они нужны и следующему.
+        for key in [key for key, used in self.last_used.items() if used < self.generation]:
+            del self.frames[key]
+            del self.last_used[key]
+        # Маски живут, пока их кадр остаётся хотя бы под одним ключом
+        live = set()
+        for frames in self.frames.values():
+            live.update(frames if isinstance(frames, tuple) else (frames,))
+        self.masks = {image: mask for image, mask in self.masks.items() if image in live}
+        self.generation += 1
+
+    def mask(self, image):
+        return self.masks[image]
+
+    def has_source(self, path):
+        # Есть ли в кэше кадры из этого файла (второй элемент любого ключа — путь к файлу)
+        return any(key[1] == path for key in self.frames)
+
+
+frame_cache = FrameCache()
+
+
+# Равномерная сетка для быстрого поиска объектов рядом с прямоугольником.
+# Каждый объект помнит порядковый номер вставки, поэтому кандидаты выдаются
+# в том же порядке, в каком их перебирала бы обычная группа спрайтов.
+class SpatialHash:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (cx, cy) -> {объект: порядковый номер}
+        self.items = {}  # объект -> (порядковый номер, занятые ячейки)
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def cells_for(self, rect, margin=0):
+        size = self.cell_size
+        left = (rect.left - margin) // size
+        right = (rect.right + margin - 1) // size
+        top = (rect.top - margin) // size
+        bottom = (rect.bottom + margin - 1) // size
+        return [(cx, cy) for cx in range(left, right + 1) for cy in range(top, bottom + 1)]
+
+    def insert(self, item, rect):
+        order = self.counter
+        self.counter += 1
+        cells = self.cells_for(rect)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[item] = order
+        self.items[item] = (order, cells)
+
+    def remove(self, item):
+        order, cells = self.items.pop(item)
+        for cell in cells:
+            bucket = self.cells[cell]
+            del bucket[item]
+            if not bucket:
+                del self.cells[cell]
+
+    def move(self, item, rect):
+        # Перекладываем объект в новые ячейки, сохраняя его порядковый номер
+        order, cells = self.items[item]
+        new_cells = self.cells_for(rect)
+        if new_cells == cells:
+            return
+        for cell in cells:
+            bucket = self.cells[cell]
+            del bucket[item]
+            if not bucket:
+                del self.cells[cell]
+        for cell in new_cells:
+            self.cells.setdefault(cell, {})[item] = order
+        self.items[item] = (order, new_cells)
+
+    def candidates(self, rect, margin=0):
+        # Объекты из ячеек, которые накрывает прямоугольник: {объект: порядковый номер}
+        found = {}
+        for cell in self.cells_for(rect, margin):
+            bucket = self.cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        return found
+
+    def query(self, rect, margin=0):
+        found = self.candidates(rect, margin)
+        return sorted(found, key=found.get)
+
+    def scan(self, rect, margin=0):
+        # Перебор кандидатов для rect, который меняется во время обработки столкновений.
+        # Если после очередного объекта rect сдвинулся, дозапрашиваем соседние ячейки:
+        # результат совпадает с полным перебором в порядке вставки.
+        found = self.candidates(rect, margin)
+        pending = sorted(found.items(), key=lambda pair: pair[1], reverse=True)
+        state = tuple(rect)
+        while pending:
+            item, order = pending.pop()
+            yield item
+            if tuple(rect) != state:
+                state = tuple(rect)
+                fresh = [(other, other_order) for other, other_order in self.candidates(rect, margin).items()
+                         if other_order > order and other not in found]
+                if fresh:
+                    found.update(fresh)
+                    pending.extend(fresh)
+                    pending.sort(key=lambda pair: pair[1], reverse=True)
+
+
+# Группа спрайтов, которая дополнительно раскладывает спрайты по сетке.
+# Добавление, kill() и удаление обновляют сетку автоматически,
+# а подвижные спрайты нужно перекладывать через refresh() после обновления.
+class SpatialGroup(pg.sprite.Group):
+    def __init__(self, cell_size, *sprites):
+        self.index = SpatialHash(cell_size)
+        super(SpatialGroup, self).__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        if sprite not in self.index.items:
+            self.index.insert(sprite, sprite.rect)
+        super(SpatialGroup, self).add_internal(sprite, layer)
+
+    def remove_internal(self, sprite):
+        self.index.remove(sprite)
+        super(SpatialGroup, self).remove_internal(sprite)
+
+    def refresh(self, sprite):
+        if sprite in self.index.items:
+            self.index.move(sprite, sprite.rect)
+
+    def visible(self, view_rect):
+        # Спрайты, пересекающие view_rect, в порядке добавления в группу
+        return [sprite for sprite in self.index.query(view_rect) if sprite.rect.colliderect(view_rect)]
+
+
+class MaskedSprite(pg.sprite.Sprite):
+    # Анимированный спрайт: маска текущего кадра посчитана заранее в кэше кадров, image задаёт подкласс
+    __slots__ = ()
+
+    @property
+    def mask(self):
+        return frame_cache.mask(self.image)
+
+
+class Player(MaskedSprite):
+    # Состояние экземпляра лежит в слотах; кадры анимации, гравитация и интервалы общие для класса
+    __slots__ = ("current_animation", "animation_start", "rect", "velocity_x", "velocity_y",
+                 "is_jumping", "map_width", "map_height", "hp", "damage_timer")
+    gravity = GRAVITY
+    interval = 200
+    damage_interval = 1000
+
     def __init__(self, map_width, map_height):
         super(Player, self).__init__()
         self.load_animations()  # Загрузка анимаций
         self.current_animation = self.idle_animation_right
-        self.image = self.current_animation[0]
-        self.current_image = 0
+        self.animation_start = 0
         self.rect = self.image.get_rect()
         self.rect.center = (72, 832)
 
         # Начальные параметры движения и положения
         self.velocity_x = 0
         self.velocity_y = 0
-        self.gravity = GRAVITY
         self.is_jumping = False
         self.map_width = map_width * TILE_SCALE
         self.map_height = map_height * TILE_SCALE
 
-        self.timer = pg.time.get_ticks()
-        self.interval = 200
-
         self.hp = 10  # Здоровье игрока
-        self.damage_timer = pg.time.get_ticks()
-        self.damage_interval = 1000
+        self.damage_timer = sim_clock.get_ticks()
 
     def get_damage(self):
-        if pg.time.get_ticks() - self.damage_timer > self.damage_interval:
+        if sim_clock.get_ticks() - self.damage_timer > self.damage_interval:
             self.hp -= 1
-            self.damage_timer = pg.time.get_ticks()
+            self.damage_timer = sim_clock.get_ticks()
+
+    @property
+    def image(self):
+        return animation_clock.frame(self.current_animation, self.interval, self.animation_start)
 
-    def load_animations(self):
+    @classmethod
+    def load_animations(cls):
         tile_size = 32
         tile_scale = 4
 
-        self.idle_animation_right = []
-
-        num_images = 5
-        sptitesheet = pg.image.load("sprites/Sprite Pack 3/2 - Twiggy/Idle (32 x 32).png")
-
-        for i in range(num_images):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = sptitesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.idle_animation_right.append(image)
-
-        self.idle_animation_left = [pg.transform.flip(image, True, False) for image in self.idle_animation_right]
-
-        self.move_animation_right = []
-
-        num_images = 6
-        sptitesheet = pg.image.load("sprites/Sprite Pack 3/2 - Twiggy/Running (32 x 32).png")
-
-        for i in range(num_images):
-            x = i * tile_size
-            y = 0
-            rect = pg.Rect(x, y, tile_size, tile_size)
-            image = sptitesheet.subsurface(rect)
-            image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-            self.move_animation_right.append(image)
-
-        self.move_animation_left = [pg.transform.flip(image, True, False) for image in self.move_animation_right]
-
-    def update(self, platforms):
-        keys = pg.key.get_pressed()
-        if keys[pg.K_SPACE] and not self.is_jumping:
+        # Кадры берутся из общего кэша: лист загружается и нарезается один раз на процесс
+        cls.idle_animation_right = frame_cache.strip(
+            "sprites/Sprite Pack 3/2 - Twiggy/Idle (32 x 32).png", (tile_size, tile_size), 5, tile_scale)
+        cls.idle_animation_left = frame_cache.strip(
+            "sprites/Sprite Pack 3/2 - Twiggy/Idle (32 x 32).png", (tile_size, tile_size), 5, tile_scale, flip=True)
+
+        cls.move_animation_right = frame_cache.strip(
+            "sprites/Sprite Pack 3/2 - Twiggy/Running (32 x 32).png", (tile_size, tile_size), 6, tile_scale)
+        cls.move_animation_left = frame_cache.strip(
+            "sprites/Sprite Pack 3/2 - Twiggy/Running (32 x 32).png", (tile_size, tile_size), 6, tile_scale,
+            flip=True)
+
+    def update(self, platforms, controls=None):
+        # controls — флаги ввода текущего тика (живая клавиатура или запись)
+        if controls is None:
+            controls = read_keyboard()
+        if controls & INPUT_JUMP and not self.is_jumping:
             self.jump()
 
-        if keys[pg.K_a]:
+        if controls & INPUT_LEFT:
             self.velocity_x = -MOVE_SPEED
             self.switch_animation(self.move_animation_left)
-        elif keys[pg.K_d]:
+        elif controls & INPUT_RIGHT:
             self.velocity_x = MOVE_SPEED
             self.switch_animation(self.move_animation_right)
         else:
@@ -113,8 +608,6 @@ class Player(pg.sprite.Sprite):
         self.is_jumping = True
         self.handle_vertical_collisions(platforms)
 
-        self.animate()
-
         # Ограничение перемещения по карте
         self.constrain_to_map()
 
@@ -127,17 +620,17 @@ class Player(pg.sprite.Sprite):
         # Переключение анимации персонажа, если текущая анимация отличается от новой
         if self.current_animation != new_animation:
             self.current_animation = new_animation
-            self.current_image = 0
+            self.animation_start = animation_clock.step(self.interval)
 
     def switch_to_idle(self):
         # Переключение на анимацию покоя, если персонаж не двигается
         if self.current_animation in [self.move_animation_right, self.move_animation_left]:
             self.current_animation = self.idle_animation_right if self.current_animation == self.move_animation_right else self.idle_animation_left
-            self.current_image = 0
+            self.animation_start = animation_clock.step(self.interval)
 
     def handle_horizontal_collisions(self, platforms):
-        # Обработка горизонтальных столкновений с платформами
-        for platform in platforms:
+        # Обработка горизонтальных столкновений с платформами (только соседние тайлы из сетки)
+        for platform in platforms.scan(self.rect):
             if self.rect.colliderect(platform.rect):
                 if self.velocity_x > 0:
                     self.rect.right = platform.rect.left
@@ -145,8 +638,8 @@ class Player(pg.sprite.Sprite):
                     self.rect.left = platform.rect.right
 
     def handle_vertical_collisions(self, platforms):
-        # Обработка вертикальных столкновений с платформами
-        for platform in platforms:
+        # Обработка вертикальных столкновений с платформами (только соседние тайлы из сетки)
+        for platform in platforms.scan(self.rect):
             if self.rect.colliderect(platform.rect):
                 if self.velocity_y > 0:
                     self.rect.bottom = platform.rect.top
@@ -155,13 +648,6 @@ class Player(pg.sprite.Sprite):
                     self.rect.top = platform.rect.bottom
                 self.velocity_y = 0
 
-    def animate(self):
-        # Обработка анимации персонажа
-        if pg.time.get_ticks() - self.timer > self.interval:
-            self.current_image = (self.current_image + 1) % len(self.current_animation)
-            self.image = self.current_animation[self.current_image]
-            self.timer = pg.time.get_ticks()
-
     def constrain_to_map(self):
         # Ограничение перемещения игрока в пределах карты
         self.rect.right = min(self.rect.right, self.map_width)
@@ -176,17 +662,20 @@ class Player(pg.sprite.Sprite):
 
 
 # Класс Crab определяет врага-краба в игре
-class Crab(pg.sprite.Sprite):
+class Crab(MaskedSprite):
     # Параметры движения для краба
     CRAB_GRAVITY = 2
     CRAB_MOVE_SPEED = 2
 
+    __slots__ = ("current_animation", "rect", "left_edge", "right_edge",
+                 "velocity_x", "velocity_y", "map_width", "map_height", "direction")
+    gravity = CRAB_GRAVITY
+    interval = 200
+
     def __init__(self, map_width, map_height, start_pos, final_pos):
         super(Crab, self).__init__()
         self.load_animations()
         self.current_animation = self.animation
-        self.image = self.current_animation[0]
-        self.current_image = 0
         self.rect = self.image.get_rect()
         self.rect.bottomleft = start_pos
         self.left_edge = start_pos[0]
@@ -195,44 +684,119 @@ class Crab(pg.sprite.Sprite):
         # Инициализация начальных параметров движения
         self.velocity_x = 0
         self.velocity_y = 0
-        self.gravity = self.CRAB_GRAVITY
         self.map_width = map_width * TILE_SCALE
         self.map_height = map_height * TILE_SCALE
 
-        self.timer = pg.time.get_ticks()
-        self.interval = 200
         self.direction = "right"
 
-    def load_animations(self):
+    @property
+    def image(self):
+        return animation_clock.frame(self.current_animation, self.interval)
+
+    @classmethod
+    def load_animations(cls):
         tile_scale = 4
         tile_size = 32
-        self.animation = []
-        image = pg.image.load(
-            "sprites/Sprite Pack 2/9 - Snip Snap Crab/Movement_(Flip_image_back_and_forth) (32 x 32).png")
-        image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-        self.animation.append(image)
-        self.animation.append(pg.transform.flip(image, True, False))
+        cls.animation = frame_cache.mirrored(
+            "sprites/Sprite Pack 2/9 - Snip Snap Crab/Movement_(Flip_image_back_and_forth) (32 x 32).png",
+            (tile_size * tile_scale, tile_size * tile_scale))
 
     def update(self, platforms):
         # Обновление направления движения краба и его положения
-        if self.direction == "right":
-            self.velocity_x = self.CRAB_MOVE_SPEED
-            if self.rect.right >= self.right_edge:
-                self.direction = "left"
-        elif self.direction == "left":
-            self.velocity_x = -self.CRAB_MOVE_SPEED
-            if self.rect.left <= self.left_edge:
-                self.direction = "right"
-
-        self.rect.x += self.velocity_x
+        self.rect.x, self.direction, self.velocity_x = self.patrol_step(self.rect.x, self.direction, self.velocity_x)
         self.rect.y += self.velocity_y + self.gravity
 
         self.handle_platform_collisions(platforms)
-        self.animate()
+
+    def patrol_step(self, x, direction, velocity_x):
+        # Один тик патруля по горизонтали: (x, направление, скорость) -> то же после тика
+        if direction == "right":
+            velocity_x = self.CRAB_MOVE_SPEED
+            if x + self.rect.width >= self.right_edge:
+                direction = "left"
+        elif direction == "left":
+            velocity_x = -self.CRAB_MOVE_SPEED
+            if x <= self.left_edge:
+                direction = "right"
+        return x + velocity_x, direction, velocity_x
+
+    def patrol_after(self, ticks=None):
+        # Патруль в замкнутом виде: (x, направление, скорость, min x, max x) через ticks тиков,
+        # None — весь дальнейший путь. Между разворотами x меняется линейно, поэтому шагаем
+        # сразу до разворота, а когда начало отрезка повторилось — остаток берём по модулю периода
+        speed = self.CRAB_MOVE_SPEED
+        x, direction, velocity_x = self.rect.x, self.direction, self.velocity_x
+        low = high = x
+        elapsed = 0
+        starts = {}  # (x, направление) в начале отрезка -> тик
+        while ticks is None or elapsed < ticks:
+            start = starts.get((x, direction))
+            if start is not None:
+                if ticks is None:
+                    break
+                elapsed = ticks - (ticks - elapsed) % (elapsed - start)
+                starts = {}
+                continue
+            starts[(x, direction)] = elapsed
+            # Разворот — на тике, где патруль упирается в границу (см. patrol_step); шаг этого тика ещё вперёд
+            if direction == "right":
+                sign, turn = 1, max(0, -((x + self.rect.width - self.right_edge) // speed))
+            elif direction == "left":
+                sign, turn = -1, max(0, -((self.left_edge - x) // speed))
+            else:
+                break
+            steps = turn + 1 if ticks is None else min(turn + 1, ticks - elapsed)
+            x += sign * speed * steps
+            velocity_x = sign * speed
+            if steps == turn + 1:
+                direction = "left" if direction == "right" else "right"
+            elapsed += steps
+            low, high = min(low, x), max(high, x)
+        return x, direction, velocity_x, low, high
+
+    def patrol_is_flat(self, platforms, low, high):
+        # На всём пути x от low до high столкновения ничего не меняют: ни одна платформа не задевает
+        # тело краба, а под midbottom везде пол ровно на уровне его нижнего края
+        width, height = self.rect.size
+        body = pg.Rect(low, self.rect.top, high - low + width + 1, height)
+        if any(platform.rect.colliderect(body) for platform in platforms.query(body)):
+            return False
+        bottom = self.rect.bottom
+        feet = pg.Rect(low + width // 2, bottom, high - low + 1, self.gravity + 1)
+        spans = sorted((platform.rect.left, platform.rect.right) for platform in platforms.query(feet)
+                       if platform.rect.top == bottom and platform.rect.bottom > bottom + self.gravity)
+        reach = feet.left
+        for left, right in spans:
+            if left > reach:
+                return False
+            reach = max(reach, right)
+        return reach >= feet.right
+
+    def falls_freely(self, platforms, low, high, floor):
+        # Под всем путём краба до floor (низ карты) нет ни одной платформы: он падает, ни во что не упираясь
+        column = pg.Rect(low, self.rect.top, high - low + self.rect.width + 1, max(0, floor - self.rect.top))
+        return not any(platform.rect.colliderect(column) for platform in platforms.query(column))
+
+    def can_catch_up(self, platforms, floor):
+        # Спать можно, только если путь считается в замкнутом виде: ровный патруль или свободное падение
+        _, _, _, low, high = self.patrol_after()
+        return self.patrol_is_flat(platforms, low, high) or self.falls_freely(platforms, low, high, floor)
+
+    def catch_up(self, ticks, platforms):
+        # Догон после сна за O(1) от длины сна: x — по формуле патруля, y не меняется на ровном полу,
+        # а при свободном падении растёт на velocity_y + gravity за тик (краб заснул, только если
+        # can_catch_up, поэтому других случаев нет)
+        x, direction, velocity_x, low, high = self.patrol_after(ticks)
+        if not self.patrol_is_flat(platforms, low, high):
+            self.rect.y += (self.velocity_y + self.gravity) * ticks
+        self.rect.x = x
+        self.direction = direction
+        self.velocity_x = velocity_x
 
     def handle_platform_collisions(self, platforms):
-        # Обработка столкновений краба с платформами
-        for platform in platforms:
+        # Обработка столкновений краба с платформами.
+        # Точки midbottom/midright лежат на границе rect, поэтому расширяем запрос на 1 пиксель
+        for platform in platforms.scan(self.rect, margin=1):
             if platform.rect.collidepoint(self.rect.midbottom):
                 self.rect.bottom = platform.rect.top
                 self.velocity_y = 0
@@ -247,15 +811,6 @@ class Crab(pg.sprite.Sprite):
             if platform.rect.collidepoint(self.rect.midleft):
                 self.rect.left = platform.rect.right
 
-    def animate(self):
-        # Анимация движения краба
-        if pg.time.get_ticks() - self.timer > self.interval:
-            self.current_image += 1
-            if self.current_image >= len(self.current_animation):
-                self.current_image = 0
-            self.image = self.current_animation[self.current_image]
-            self.timer = pg.time.get_ticks()
-
 
 # Класс Pumpkin определяет врага-тыкву в игре
 class Pumpkin(Crab):  # Унаследован от Crab, так как логика похожа
@@ -263,8 +818,10 @@ class Pumpkin(Crab):  # Унаследован от Crab, так как логи
     # Например, если у тыквы другая скорость движения
     PUMPKIN_MOVE_SPEED = 3
 
+    __slots__ = ()
+
     def __init__(self, map_width, map_height):
-        super(Pumpkin, self).__init__(map_width, map_height)
+        super(Pumpkin, self).__init__(map_width, map_height, (1430, 900), (1600, 900))
         self.velocity_x = self.PUMPKIN_MOVE_SPEED
         self.load_animations()
         self.rect = self.image.get_rect()
@@ -275,58 +832,384 @@ class Pumpkin(Crab):  # Унаследован от Crab, так как логи
         # Используем параметры движения из Crab
         self.direction = "right"
 
-    def load_animations(self):
+    @classmethod
+    def load_animations(cls):
         tile_scale = 4
         tile_size = 16
-        self.animation = []
-        image = pg.image.load("sprites/Sprite Pack 2/4 - Robo Pumpkin/Standing (16 x 16).png")
-        image = pg.transform.scale(image, (tile_size * tile_scale, tile_size * tile_scale))
-        self.animation.append(image)
-        self.animation.append(pg.transform.flip(image, True, False))
+        cls.animation = frame_cache.mirrored("sprites/Sprite Pack 2/4 - Robo Pumpkin/Standing (16 x 16).png",
+                                             (tile_size * tile_scale, tile_size * tile_scale))
+
+
+# Сетка тайлов с номером коллайдера в каждой клетке (NumPy). Коллайдеры собраны из целых тайлов
+# и не пересекаются, поэтому точка лежит в коллайдере тогда и только тогда, когда в нём её тайл
+class ColliderGrid:
+    def __init__(self, colliders, tile_width, tile_height, columns, rows):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.owner = np.full((rows, columns), -1, np.int64)
+        tops = []
+        for number, collider in enumerate(colliders):
+            rect = collider.rect
+            self.owner[rect.top // tile_height:rect.bottom // tile_height,
+                       rect.left // tile_width:rect.right // tile_width] = number
+            tops.append(rect.top)
+        self.collider_top = np.array(tops, np.int64)
+
+    def owners(self, px, py):
+        # Номер коллайдера, в котором лежит каждая точка (-1 — ни в каком)
+        rows, columns = self.owner.shape
+        tx = px // self.tile_width
+        ty = py // self.tile_height
+        inside = (tx >= 0) & (tx < columns) & (ty >= 0) & (ty < rows)
+        result = np.full(px.shape, -1, np.int64)
+        result[inside] = self.owner[ty[inside], tx[inside]]
+        return result
+
+
+# Пакетное обновление патрулирующих врагов (Crab и наследники, не переопределившие поведение).
+# Положения, скорости, границы патруля и направления лежат в массивах NumPy
+# и обновляются одним векторным шагом за тик; спрайты остаются представлениями для отрисовки
+# и столкновений: им каждый тик переписывается только rect, остальное — в sync().
+class EnemySwarm:
+    MIN_BATCH = 16  # Меньше врагов — накладные расходы NumPy больше выигрыша, обновляем по одному
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.members = None  # состав группы подвижных врагов, по которому собраны массивы
+        self.sprites = []
+        self.tracked = set()
+
+    @staticmethod
+    def batchable(sprite):
+        cls = type(sprite)
+        return (isinstance(sprite, Crab) and cls.update is Crab.update
+                and cls.handle_platform_collisions is Crab.handle_platform_collisions)
+
+    def track(self, sprites):
+        self.sprites = sprites
+        self.tracked = set(sprites)
+
+        def column(values):
+            return np.array(values, np.int64)
+
+        self.x = column([sprite.rect.x for sprite in sprites])
+        self.y = column([sprite.rect.y for sprite in sprites])
+        self.width = column([sprite.rect.width for sprite in sprites])
+        self.height = column([sprite.rect.height for sprite in sprites])
+        self.velocity_x = column([sprite.velocity_x for sprite in sprites])
+        self.velocity_y = column([sprite.velocity_y for sprite in sprites])
+        self.gravity = column([sprite.gravity for sprite in sprites])
+        self.speed = column([sprite.CRAB_MOVE_SPEED for sprite in sprites])
+        self.left_edge = column([sprite.left_edge for sprite in sprites])
+        self.right_edge = column([sprite.right_edge for sprite in sprites])
+        self.direction = column([{"right": 1, "left": -1}.get(sprite.direction, 0) for sprite in sprites])
+
+    def sync(self):
+        # Полное состояние из массивов обратно в спрайты
+        if not self.sprites:
+            return
+        directions = {1: "right", -1: "left"}
+        for i, sprite in enumerate(self.sprites):
+            sprite.rect.topleft = (int(self.x[i]), int(self.y[i]))
+            sprite.velocity_x = int(self.velocity_x[i])
+            sprite.velocity_y = int(self.velocity_y[i])
+            sprite.direction = directions.get(int(self.direction[i]), sprite.direction)
+
+    def reset(self):
+        # Состояние спрайтов восстановили извне (перезапуск уровня): массивы нужно собрать заново
+        self.members = None
+        self.sprites = []
+        self.tracked = set()
+
+    def update(self, movers, platforms):
+        members = movers.sprites()
+        if members != self.members:
+            # Состав врагов изменился (убиты, добавлены): пересобираем массивы
+            self.sync()
+            self.members = members
+            batch = [sprite for sprite in members if self.batchable(sprite)]
+            self.track(batch if len(batch) >= self.MIN_BATCH else [])
+        if not self.sprites:
+            return
+
+        # Патруль: скорость по направлению, разворот у границы — как в Crab.update
+        right = self.direction == 1
+        left = self.direction == -1
+        self.velocity_x = np.where(right, self.speed, np.where(left, -self.speed, self.velocity_x))
+        turn_left = right & (self.x + self.width >= self.right_edge)
+        turn_right = left & (self.x <= self.left_edge)
+        self.direction[turn_left] = -1
+        self.direction[turn_right] = 1
+        self.x += self.velocity_x
+        self.y += self.velocity_y + self.gravity
+
+        self.handle_platform_collisions(platforms)
 
+        for sprite, x, y in zip(self.sprites, self.x.tolist(), self.y.tolist()):
+            sprite.rect.topleft = (x, y)
 
-class Ball(pg.sprite.Sprite):
-    # Константы для настроек шара
+    def handle_platform_collisions(self, platforms):
+        # Частые случаи считаются по сетке: ни одна опорная точка не в коллайдере — ничего не делаем;
+        # в коллайдере только midbottom — ставим врага на его верх. Остальные враги (упёрлись в стену,
+        # задели потолок) проходят обычный перебор Crab.handle_platform_collisions
+        owners = self.grid.owners
+        center_x = self.x + self.width // 2
+        center_y = self.y + self.height // 2
+        bottom = owners(center_x, self.y + self.height)
+        others = ((owners(center_x, self.y) >= 0) | (owners(self.x + self.width, center_y) >= 0)
+                  | (owners(self.x, center_y) >= 0))
+        landed = (bottom >= 0) & ~others
+        y = self.y.copy()
+        y[landed] = self.grid.collider_top[bottom[landed]] - self.height[landed]
+        # После посадки остальные точки не должны попасть ни в один коллайдер
+        center_y = y + self.height // 2
+        blocked = ((owners(center_x, y) >= 0) | (owners(self.x + self.width, center_y) >= 0)
+                   | (owners(self.x, center_y) >= 0))
+        fallback = others | (landed & blocked)
+        landed &= ~blocked
+        self.y = np.where(landed, y, self.y)
+        self.velocity_y[landed] = 0
+
+        for i in np.flatnonzero(fallback).tolist():
+            sprite = self.sprites[i]
+            sprite.rect.topleft = (int(self.x[i]), int(self.y[i]))
+            sprite.velocity_y = int(self.velocity_y[i])
+            sprite.handle_platform_collisions(platforms)
+            self.x[i], self.y[i] = sprite.rect.topleft
+            self.velocity_y[i] = sprite.velocity_y
+
+
+# Пул снарядов фиксированной ёмкости. Шары лежат плотно в порядке выстрелов в первых count ячейках
+# плоских массивов (NumPy, если он есть, иначе array): выстрел не создаёт ни спрайта, ни поверхности.
+# С NumPy сдвиг, проверка границ и столкновения считаются векторно за один шаг на все шары,
+# без него — тем же порядком в цикле. ids — постоянный номер шара, пока он летит (ключ интерполяции).
+class BallPool:
+    CAPACITY = 64
     BALL_SPEED = 10
     BALL_SIZE = (30, 30)
 
-    def __init__(self, player_rect, direction):
-        super(Ball, self).__init__()
-        self.direction = direction
-        self.speed = self.BALL_SPEED
-        self.image = pg.image.load("sprites/ball.png")
-        self.image = pg.transform.scale(self.image, self.BALL_SIZE)
-        self.rect = self.image.get_rect()
-
-        # Расположение шара в зависимости от направления игрока
+    def __init__(self, capacity=CAPACITY):
+        self.image = frame_cache.image("sprites/ball.png", self.BALL_SIZE)
+        self.capacity = capacity
+        if np is not None:
+            self.x, self.y, self.dx, self.ids = (np.zeros(capacity, np.int64) for _ in range(4))
+        else:
+            self.x, self.y, self.dx, self.ids = (array("i", [0]) * capacity for _ in range(4))
+        self.count = 0
+        self.free = list(range(capacity - 1, -1, -1))  # свободные номера шаров
+        self.keys = [("ball", number) for number in range(capacity)]
+        self.rect = pg.Rect((0, 0), self.BALL_SIZE)  # рабочий прямоугольник для проверок столкновений
+        # Выходные списки positions() и visible() переиспользуются от тика к тику
+        self.positions_buffer = []
+        self.visible_buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.free.extend(reversed(self.ids[:self.count].tolist()))
+        self.count = 0
+
+    def spawn(self, player_rect, direction):
+        # Шар появляется у края игрока со стороны выстрела; если пул полон, гасим самый старый
+        if self.count == self.capacity:
+            self.free.append(int(self.ids[0]))
+            for column in (self.x, self.y, self.dx, self.ids):
+                column[:-1] = column[1:]
+            self.count -= 1
+        i = self.count
+        width, height = self.BALL_SIZE
         if direction == "right":
-            self.rect.x = player_rect.right
+            self.x[i] = player_rect.right
+            self.dx[i] = self.BALL_SPEED
         else:
-            self.rect.x = player_rect.left - self.BALL_SIZE[0]  # Учитываем размер шара при движении влево
-        self.rect.centery = player_rect.centery
+            self.x[i] = player_rect.left - width  # Учитываем размер шара при движении влево
+            self.dx[i] = -self.BALL_SPEED
+        self.y[i] = player_rect.centery - height // 2
+        self.ids[i] = self.free.pop()
+        self.count += 1
+
+    def compact(self, keep):
+        # Оставляем шары с keep[i] (маска NumPy), сохраняя порядок выстрелов; номера погасших — в пул
+        n = self.count
+        if keep.all():
+            return
+        self.free.extend(self.ids[:n][~keep].tolist())
+        kept = np.flatnonzero(keep)
+        for column in (self.x, self.y, self.dx, self.ids):
+            column[:len(kept)] = column[kept]
+        self.count = len(kept)
 
     def update(self):
-        # Движение шара в зависимости от направления
-        if self.direction == "right":
-            self.rect.x += self.speed
+        # Сдвигаем все шары; улетевшие за границы экрана возвращаются в пул
+        n = self.count
+        if not n:
+            return
+        width = self.BALL_SIZE[0]
+        if np is not None:
+            x = self.x[:n]
+            x += self.dx[:n]
+            self.compact((x + width >= 0) & (x <= SCREEN_WIDTH))
+            return
+        x, dx, ids = self.x, self.dx, self.ids
+        kept = 0
+        for i in range(n):
+            x[i] += dx[i]
+            if x[i] + width < 0 or x[i] > SCREEN_WIDTH:
+                self.free.append(ids[i])
+            else:
+                self.move_slot(i, kept)
+                kept += 1
+        self.count = kept
+
+    def move_slot(self, source, target):
+        if source != target:
+            for column in (self.x, self.y, self.dx, self.ids):
+                column[target] = column[source]
+
+    def collide(self, enemies, index, platforms, grid=None):
+        # Шар гасит всех задетых врагов и гаснет сам; уцелевшие шары гаснут о платформы.
+        # Кандидаты берутся из сеток: index — сетка, в которой лежат враги, platforms — сетка коллайдеров,
+        # grid — та же сетка коллайдеров по тайлам (ColliderGrid) для векторной проверки
+        if not self.count:
+            return
+        if np is not None:
+            self.collide_batch(enemies, index, platforms, grid)
+            return
+        rect, ids = self.rect, self.ids
+        kept = 0
+        for i in range(self.count):
+            rect.topleft = (self.x[i], self.y[i])
+            hit = False
+            for sprite in index.query(rect):
+                if sprite in enemies and sprite.rect.colliderect(rect):
+                    sprite.kill()
+                    hit = True
+            if not hit:
+                hit = self.hits_platform(rect, platforms)
+            if hit:
+                self.free.append(ids[i])
+            else:
+                self.move_slot(i, kept)
+                kept += 1
+        self.count = kept
+
+    def collide_batch(self, enemies, index, platforms, grid):
+        n = self.count
+        width, height = self.BALL_SIZE
+        x, y = self.x[:n], self.y[:n]
+        hit = np.zeros(n, bool)
+
+        # Враги: кандидаты из сетки по общему прямоугольнику всех шаров, пересечения — матрицей шар x враг
+        left, top = int(x.min()), int(y.min())
+        area = pg.Rect(left, top, int(x.max()) - left + width, int(y.max()) - top + height)
+        candidates = [sprite for sprite in index.query(area) if sprite in enemies]
+        if candidates:
+            enemy_x, enemy_y, enemy_width, enemy_height = np.array(
+                [tuple(sprite.rect) for sprite in candidates], np.int64).T
+            overlap = ((x[:, None] < enemy_x + enemy_width) & (x[:, None] + width > enemy_x)
+                       & (y[:, None] < enemy_y + enemy_height) & (y[:, None] + height > enemy_y))
+            # Как при поочерёдной проверке шаров: врага гасит первый задевший его шар,
+            # а следующие шары его уже не видят и летят дальше
+            touched = overlap.any(axis=0)
+            hit[overlap.argmax(axis=0)[touched]] = True
+            for j in np.flatnonzero(touched).tolist():
+                candidates[j].kill()
+
+        # Платформы. Коллайдеры сложены из целых тайлов, поэтому шар не больше тайла задевает
+        # коллайдер тогда и только тогда, когда в коллайдере лежит один из его углов
+        if grid is not None and width <= grid.tile_width and height <= grid.tile_height:
+            right, bottom = x + width - 1, y + height - 1
+            hit |= ((grid.owners(x, y) >= 0) | (grid.owners(right, y) >= 0)
+                    | (grid.owners(x, bottom) >= 0) | (grid.owners(right, bottom) >= 0))
         else:
-            self.rect.x -= self.speed
-
-        # Удаление шара, если он выходит за границы экрана
-        if self.rect.right < 0 or self.rect.left > SCREEN_WIDTH:
-            self.kill()
-
-
-class Platform(pg.sprite.Sprite):
-    # Конструктор класса Platform
-    def __init__(self, image, x, y, width, height):
-        super(Platform, self).__init__()
-        # Масштабируем изображение платформы в соответствии с заданным размером тайла
-        self.image = pg.transform.scale(image, (width * TILE_SCALE, height * TILE_SCALE))
-        self.rect = self.image.get_rect()
-        # Установка позиции платформы на карте
-        self.rect.x = x * TILE_SCALE
-        self.rect.y = y * TILE_SCALE
+            rect = self.rect
+            for i in np.flatnonzero(~hit).tolist():
+                rect.topleft = (int(x[i]), int(y[i]))
+                hit[i] = self.hits_platform(rect, platforms)
+        self.compact(~hit)
+
+    @staticmethod
+    def hits_platform(rect, platforms):
+        for platform in platforms.query(rect):
+            if platform.rect.colliderect(rect):
+                return True
+        return False
+
+    def positions(self):
+        # (ключ, положение) для отрисовки и интерполяции; ключ постоянен, пока шар летит
+        n, keys = self.count, self.keys
+        positions = self.positions_buffer
+        positions.clear()
+        positions.extend((keys[number], (x, y)) for number, x, y
+                         in zip(self.ids[:n].tolist(), self.x[:n].tolist(), self.y[:n].tolist()))
+        return positions
+
+    def visible(self, view_rect):
+        visible = self.visible_buffer
+        visible.clear()
+        width, height = self.BALL_SIZE
+        for key, (x, y) in self.positions():
+            if (x < view_rect.right and x + width > view_rect.left
+                    and y < view_rect.bottom and y + height > view_rect.top):
+                visible.append((key, (x, y)))
+        return visible
+
+
+# Невидимый прямоугольник столкновений, собранный из нескольких твёрдых тайлов
+class Collider(pg.sprite.Sprite):
+    __slots__ = ("rect",)
+
+    def __init__(self, x, y, width, height):
+        super(Collider, self).__init__()
+        self.rect = pg.Rect(x * TILE_SCALE, y * TILE_SCALE, width * TILE_SCALE, height * TILE_SCALE)
+
+
+def merge_solid_tiles(solid_tiles):
+    # Жадное объединение тайлов: сначала непрерывные отрезки в каждой строке,
+    # затем одинаковые отрезки соседних строк склеиваются в один прямоугольник.
+    # Возвращает список (x, y, ширина, высота) в тайлах.
+    # Выталкивание при этом меняется там, где спрайт оказался внутри твёрдой области глубже одного тайла
+    # (появился в стене или ступени, проскочил угол за тик): его выносит к краю всего прямоугольника,
+    # а не к краю тайла, в который он попал. На обычных стыках и углах результат тот же;
+    # сравнение с коллайдером на каждый тайл — группа colliders в bench.py (PLATFORMER_MERGED_COLLIDERS=0)
+    rows = {}
+    for x, y in solid_tiles:
+        rows.setdefault(y, []).append(x)
+
+    rects = []
+    open_rects = {}  # (x, ширина) -> прямоугольник, дошедший до предыдущей строки
+    for y in sorted(rows):
+        xs = sorted(rows[y])
+        runs = []
+        start = previous = xs[0]
+        for x in xs[1:]:
+            if x != previous + 1:
+                runs.append((start, previous - start + 1))
+                start = x
+            previous = x
+        runs.append((start, previous - start + 1))
+
+        next_open = {}
+        for run in runs:
+            rect = open_rects.pop(run, None)
+            if rect is not None and rect[1] + rect[3] == y:
+                rect[3] += 1
+            else:
+                if rect is not None:
+                    rects.append(rect)
+                rect = [run[0], y, run[1], 1]
+            next_open[run] = rect
+        rects.extend(open_rects.values())
+        open_rects = next_open
+    rects.extend(open_rects.values())
+    return [tuple(rect) for rect in rects]
+
+
+def split_merged_tiles(rects):
+    # Обратно к тайлам 1x1 в порядке обхода слоя (строка за строкой), как коллайдеры шли до объединения
+    tiles = sorted((y + dy, x + dx) for x, y, width, height in rects for dy in range(height) for dx in range(width))
+    return [(x, y, 1, 1) for y, x in tiles]
 
 
 class Coin(pg.sprite.Sprite):
@@ -336,90 +1219,493 @@ class Coin(pg.sprite.Sprite):
     ANIMATION_INTERVAL = 200
     NUM_IMAGES = 4
 
+    __slots__ = ("rect",)
 
     def __init__(self, x, y):
         super(Coin, self).__init__()
         self.load_animations()
-        self.image = self.images[0]
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.y = y
-        self.current_image = 0
-        self.timer = pg.time.get_ticks()
 
-    def load_animations(self):
-        self.images = []
-        spritesheet = pg.image.load("sprites/spr_coin_strip4.png")
+    @property
+    def image(self):
+        # Все монеты крутятся синхронно по общим часам анимации
+        return animation_clock.frame(self.images, self.ANIMATION_INTERVAL)
 
-        # Загружаем кадры анимации из спрайт-листа
-        for i in range(self.NUM_IMAGES):
-            image = spritesheet.subsurface((i * self.COIN_SIZE[0], 0, self.COIN_SIZE[0], self.COIN_SIZE[1]))
-            image = pg.transform.scale(image,
-                                       (self.COIN_SIZE[0] * self.COIN_SCALE, self.COIN_SIZE[1] * self.COIN_SCALE))
-            self.images.append(image)
+    @classmethod
+    def load_animations(cls):
+        # Загружаем кадры анимации из спрайт-листа (через общий кэш); кадры общие для всех монет
+        cls.images = frame_cache.strip("sprites/spr_coin_strip4.png", cls.COIN_SIZE, cls.NUM_IMAGES,
+                                       cls.COIN_SCALE)
 
-    def update(self):
-        # Анимация монеты
-        if pg.time.get_ticks() - self.timer > self.ANIMATION_INTERVAL:
-            self.current_image = (self.current_image + 1) % len(self.images)
-            self.image = self.images[self.current_image]
-            self.timer = pg.time.get_ticks()
 
-class Portal(pg.sprite.Sprite):
+class Portal(MaskedSprite):
     # Константы для анимации монеты
     COIN_SIZE = (64, 64)
     COIN_SCALE = 4
     ANIMATION_INTERVAL = 100
     NUM_IMAGES = 8
 
+    __slots__ = ("rect",)
 
     def __init__(self, x, y):
         super(Portal, self).__init__()
         self.load_animations()
-        self.image = self.images[0]
-        self.mask = pg.mask.from_surface(self.image)
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.bottom = y
-        self.current_image = 0
-        self.timer = pg.time.get_ticks()
 
-    def load_animations(self):
-        self.images = []
-        spritesheet = pg.image.load("sprites/Green Portal Sprite Sheet.png").convert_alpha()
+    @property
+    def image(self):
+        return animation_clock.frame(self.images, self.ANIMATION_INTERVAL)
 
-        # Загружаем кадры анимации из спрайт-листа
-        for i in range(self.NUM_IMAGES):
-            image = spritesheet.subsurface((i * self.COIN_SIZE[0], 0, self.COIN_SIZE[0], self.COIN_SIZE[1]))
-            image = pg.transform.scale(image,
-                                       (self.COIN_SIZE[0] * self.COIN_SCALE, self.COIN_SIZE[1] * self.COIN_SCALE))
-            self.images.append(image)
+    @classmethod
+    def load_animations(cls):
+        # Загружаем кадры анимации из спрайт-листа (через общий кэш)
+        cls.images = frame_cache.strip("sprites/Green Portal Sprite Sheet.png", cls.COIN_SIZE, cls.NUM_IMAGES,
+                                       cls.COIN_SCALE)
 
-    def update(self):
-        # Анимация монеты
-        if pg.time.get_ticks() - self.timer > self.ANIMATION_INTERVAL:
-            self.current_image = (self.current_image + 1) % len(self.images)
-            self.image = self.images[self.current_image]
-            self.timer = pg.time.get_ticks()
-
-class Ship(pg.sprite.Sprite):
-    # Конструктор класса Platform
-    def __init__(self, image, x, y, width, height):
-        super(Ship, self).__init__()
-        # Масштабируем изображение платформы в соответствии с заданным размером тайла
-        self.image = pg.transform.scale(image, (width * TILE_SCALE, height * TILE_SCALE))
-        self.rect = self.image.get_rect()
-        # Установка позиции платформы на карте
-        self.rect.x = x * TILE_SCALE
-        self.rect.y = y * TILE_SCALE
 
+# Шип — статичная геометрия, а не спрайт: рисуется в чанках статического слоя,
+# а для столкновений хранит только прямоугольник и маску, общую для всех шипов одного тайла
+class Ship:
+    __slots__ = ("rect", "mask")
 
+    def __init__(self, mask, x, y, width, height):
+        self.mask = mask
+        self.rect = pg.Rect(x * TILE_SCALE, y * TILE_SCALE, width * TILE_SCALE, height * TILE_SCALE)
 
-class Game:
-    # Конструктор класса Game
+
+def entity_state(sprite):
+    # Атрибуты спрайта из слотов и из __dict__, который всё равно заводит базовый pg.sprite.Sprite.
+    # Словарь групп самого спрайта не берётся: членство восстанавливается через add()
+    state = {name: value for name, value in vars(sprite).items() if name != "_Sprite__g"}
+    for cls in type(sprite).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(sprite, name):
+                state[name] = getattr(sprite, name)
+    return state
+
+
+# Статические слои карты, запечённые в крупные куски (чанки).
+# Чанк собирается при первом попадании в камеру и хранится в LRU-кэше,
+# так что за кадр рисуется несколько поверхностей вместо тысяч тайлов.
+class ChunkRenderer:
+    CHUNK_SIZE = 512
+    MAX_CHUNKS = 48
+
+    def __init__(self):
+        self.tiles = {}  # (cx, cy) -> [(изображение, rect)]
+        self.chunks = OrderedDict()  # (cx, cy) -> готовая поверхность, от давно не использованных к свежим
+
+    def add(self, image, rect):
+        # Тайл попадает во все чанки, которые он задевает
+        size = self.CHUNK_SIZE
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                self.tiles.setdefault((cx, cy), []).append((image, rect))
+
+    def build_chunk(self, key):
+        size = self.CHUNK_SIZE
+        chunk = pg.Surface((size, size), pg.SRCALPHA)
+        offset_x = key[0] * size
+        offset_y = key[1] * size
+        chunk_rect = chunk.get_rect(topleft=(offset_x, offset_y))
+        covered = 0
+        for image, rect in self.tiles[key]:
+            chunk.blit(image, (rect.x - offset_x, rect.y - offset_y))
+            covered += rect.clip(chunk_rect).width * rect.clip(chunk_rect).height
+        # Доля пустого места по площади тайлов — без подсчёта маски по всему чанку
+        return prepare_surface(chunk, max(0, 1 - covered / (size * size)))
+
+    def get_chunk(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.build_chunk(key)
+            self.chunks[key] = chunk
+            if len(self.chunks) > self.MAX_CHUNKS:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(key)
+        return chunk
+
+    def draw(self, screen, camera_x, camera_y):
+        # Рисуем только чанки, пересекающиеся с камерой; возвращаем число blit-вызовов
+        size = self.CHUNK_SIZE
+        width, height = screen.get_size()
+        left = int(camera_x) // size
+        top = int(camera_y) // size
+        right = int(camera_x + width) // size
+        bottom = int(camera_y + height) // size
+        blits = 0
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                if (cx, cy) not in self.tiles:
+                    continue
+                chunk_rect = pg.Rect(cx * size, cy * size, size, size)
+                screen.blit(self.get_chunk((cx, cy)), chunk_rect.move(-camera_x, -camera_y))
+                blits += 1
+        return blits
+
+
+# Скомпилированный уровень: TMX и JSON с врагами один раз переводятся в двоичный файл
+# (упакованные массивы тайлов, объединённые прямоугольники столкновений, таблица врагов)
+# и атлас с использованными тайлами. Файл отображается в память при загрузке, а пересобирается,
+# если у исходников (TMX, JSON и картинок тайлсетов) изменилось время модификации или содержимое
+LEVEL_CACHE_DIR = "maps/.cache"
+LEVEL_MAGIC = b"PLVL"
+LEVEL_VERSION = 2
+# метка, версия, mtime TMX, mtime JSON, sha1 исходников, ширина, высота, размер тайла,
+# число слоёв, прямоугольников, врагов, тайлов атласа и картинок тайлсетов
+LEVEL_HEADER = struct.Struct("<4sHqq20sIIHHHIIII")
+LEVEL_LAYER_NAME = struct.Struct("<32s")
+LEVEL_RECT = struct.Struct("<4i")  # x, y, ширина, высота в тайлах
+LEVEL_SPAWN = struct.Struct("<B4i")  # вид, начальная и конечная точки в тайлах
+LEVEL_IMAGE = struct.Struct("<qH")  # mtime картинки тайлсета и длина пути, за ними путь в UTF-8
+SPAWN_KINDS = ["Crab"]
+ATLAS_COLUMNS = 32
+
+
+class CompiledLevel:
+    def __init__(self, path, atlas_path):
+        with open(path, "rb") as level_file:
+            self.buffer = mmap.mmap(level_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.tmx_mtime, self.enemies_mtime, self.source_hash, self.width, self.height,
+         self.tilewidth, self.tileheight, layer_count, rect_count, spawn_count,
+         self.atlas_count, image_count) = LEVEL_HEADER.unpack_from(self.buffer)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            raise ValueError(f"{path}: не скомпилированный уровень")
+        self.atlas_path = atlas_path
+        self.atlas_image = None  # Атлас, только что собранный компиляцией (ещё не в формате экрана)
+        self.image_futures = None  # Заказанное в asset_loader (request_images)
+        self.tile_images = None
+        self.scaled_tile_images = None
+
+        # Слои — представления памяти прямо поверх отображённого файла, без копирования
+        view = memoryview(self.buffer)
+        offset = LEVEL_HEADER.size
+        self.layers = {}
+        layer_size = self.width * self.height * 2
+        for _ in range(layer_count):
+            name = LEVEL_LAYER_NAME.unpack_from(self.buffer, offset)[0].rstrip(b"\0").decode("utf-8")
+            offset += LEVEL_LAYER_NAME.size
+            self.layers[name] = view[offset:offset + layer_size].cast("H")
+            offset += layer_size
+
+        self.rects = [LEVEL_RECT.unpack_from(self.buffer, offset + i * LEVEL_RECT.size) for i in range(rect_count)]
+        offset += rect_count * LEVEL_RECT.size
+        self.spawns = []
+        for i in range(spawn_count):
+            kind, x1, y1, x2, y2 = LEVEL_SPAWN.unpack_from(self.buffer, offset + i * LEVEL_SPAWN.size)
+            self.spawns.append((SPAWN_KINDS[kind], (x1, y1), (x2, y2)))
+        offset += spawn_count * LEVEL_SPAWN.size
+        self.images = []  # (путь, mtime) картинок тайлсетов
+        for _ in range(image_count):
+            mtime, length = LEVEL_IMAGE.unpack_from(self.buffer, offset)
+            offset += LEVEL_IMAGE.size
+            self.images.append((bytes(self.buffer[offset:offset + length]).decode("utf-8"), mtime))
+            offset += length
+
+    def is_fresh(self, tmx_path, enemies_path):
+        image_paths = [path for path, mtime in self.images]
+        return (self.tmx_mtime == os.stat(tmx_path).st_mtime_ns
+                and self.enemies_mtime == os.stat(enemies_path).st_mtime_ns
+                and all(os.path.exists(path) and os.stat(path).st_mtime_ns == mtime for path, mtime in self.images)
+                and self.source_hash == level_source_hash(tmx_path, enemies_path, image_paths))
+
+    def request_images(self):
+        # Декодирование атласа в пуле asset_loader; Future — для полосы загрузки
+        if self.image_futures is None:
+            self.image_futures = [asset_loader.request(self.atlas_path)] if self.atlas_image is None else []
+        return self.image_futures
+
+    def load_tile_images(self):
+        # Атлас: тайлы по порядку номеров (номер 0 — пустая клетка), по ATLAS_COLUMNS в строке.
+        # Заодно готовятся тайлы, увеличенные в TILE_SCALE раз, — по одному на номер
+        if self.tile_images is None:
+            atlas = self.atlas_image
+            if atlas is None:
+                atlas = asset_loader.load(self.atlas_path)
+            atlas = atlas.convert_alpha()
+            self.atlas_image = None
+            tile_images = [None]
+            scaled_tile_images = [None]
+            for i in range(self.atlas_count):
+                x = i % ATLAS_COLUMNS * self.tilewidth
+                y = i // ATLAS_COLUMNS * self.tileheight
+                tile = atlas.subsurface((x, y, self.tilewidth, self.tileheight))
+                tile_images.append(tile)
+                scaled_tile_images.append(prepare_surface(pg.transform.scale(tile, (self.tilewidth * TILE_SCALE,
+                                                                                    self.tileheight * TILE_SCALE))))
+            self.scaled_tile_images = scaled_tile_images
+            self.tile_images = tile_images
+        return self.tile_images
+
+
+def level_source_hash(tmx_path, enemies_path, image_paths):
+    digest = hashlib.sha1()
+    for path in (tmx_path, enemies_path, *image_paths):
+        with open(path, "rb") as source_file:
+            digest.update(source_file.read())
+    return digest.digest()
+
+
+def level_cache_paths(tmx_path):
+    name = os.path.splitext(os.path.basename(tmx_path))[0]
+    return os.path.join(LEVEL_CACHE_DIR, name + ".lvl"), os.path.join(LEVEL_CACHE_DIR, name + ".tiles.png")
+
+
+def tile_source_loader(filename, colorkey, **kwargs):
+    # Загрузчик для pytmx, который ничего не загружает: вместо картинки тайла — откуда её взять
+    # (файл листа, прозрачный цвет, прямоугольник на листе, флаги поворота и отражения)
+    def load(rect=None, flags=None):
+        return filename, colorkey, rect, flags
+
+    return load
+
+
+def cut_tile(sheets, source, size):
+    # Картинка тайла из уже загруженного листа, как её сделал бы загрузчик pytmx для pygame,
+    # но без перевода в формат экрана: атлас переводится целиком при загрузке уровня
+    filename, colorkey, rect, flags = source
+    sheet = sheets[filename]
+    tile = sheet.subsurface(rect) if rect else sheet.copy()
+    if flags:
+        tile = handle_transformation(tile, flags)
+    if colorkey:
+        tile.set_colorkey(pg.Color(f"#{colorkey.lstrip('#')}"))
+    if tile.get_size() != size:
+        tile = pg.transform.scale(tile, size)
+    return tile
+
+
+# Разобранные исходники уровня, которые ещё предстоит скомпилировать. Разбор читает только файлы
+# (TMX, JSON и байты листов тайлсетов) и не создаёт ни одной поверхности, поэтому годится для
+# фонового потока; compile() собирает атлас и пишет кэш — это уже работа с поверхностями
+# для главного потока. Сохраняются только слои из layer_names, номера тайлов перенумеровываются подряд
+class LevelSource:
+    def __init__(self, tmx_path, enemies_path, layer_names):
+        self.tmx_mtime = os.stat(tmx_path).st_mtime_ns
+        self.enemies_mtime = os.stat(enemies_path).st_mtime_ns
+        tmx_map = pytmx.TiledMap(tmx_path, image_loader=tile_source_loader)
+        self.level_path, self.atlas_path = level_cache_paths(tmx_path)
+        self.width, self.height = tmx_map.width, tmx_map.height
+        self.tilewidth, self.tileheight = tmx_map.tilewidth, tmx_map.tileheight
+
+        self.tile_sources = {}  # номер в атласе (с 1) -> откуда взять картинку тайла (tile_source_loader)
+        local_ids = {}  # gid в TMX -> номер в атласе
+        self.layers = []
+        solid_tiles = set()
+        for layer in tmx_map:
+            if layer.name not in layer_names or not isinstance(layer, pytmx.TiledTileLayer):
+                continue
+            packed = [0] * (tmx_map.width * tmx_map.height)
+            for x, y, gid in layer:
+                if gid and tmx_map.images[gid]:
+                    if gid not in local_ids:
+                        local_ids[gid] = len(local_ids) + 1
+                        self.tile_sources[local_ids[gid]] = tmx_map.images[gid]
+                    packed[y * tmx_map.width + x] = local_ids[gid]
+                    if layer.name == "Game":
+                        solid_tiles.add((x, y))
+            self.layers.append((layer.name, packed))
+        self.rects = merge_solid_tiles(solid_tiles)
+
+        # Листы тайлсетов, на которые ссылается карта: из них собирается атлас, и они же входят в ключ кэша
+        self.image_paths = sorted({image[0] for image in tmx_map.images if image})
+        self.image_mtimes = [os.stat(path).st_mtime_ns for path in self.image_paths]
+        self.image_futures = None
+        self.source_hash = level_source_hash(tmx_path, enemies_path, self.image_paths)
+
+        with open(enemies_path, "r") as json_file:
+            enemies = json.load(json_file)["enemies"]
+        self.spawns = [(SPAWN_KINDS.index(enemy["name"]), *enemy["start_pos"], *enemy["final_pos"])
+                       for enemy in enemies if enemy["name"] in SPAWN_KINDS]
+
+    def request_images(self):
+        # Листы тайлсетов декодируются в пуле asset_loader, там же после них собирается атлас
+        # (build_atlas ждёт листы, заказанные раньше него, так что пул не заклинит). Future — для полосы загрузки;
+        # заказываем один раз: build_atlas забирает листы из asset_loader, и повторный заказ декодировал бы их снова
+        if self.image_futures is None:
+            self.image_futures = [asset_loader.request(path) for path in self.image_paths]
+            self.image_futures.append(asset_loader.request(self.atlas_path, lambda atlas_path: self.build_atlas()))
+        return self.image_futures
+
+    def compile(self):
+        # Уровень из исходников: атлас и двоичный уровень в кэш (в пуле, см. request_images);
+        # возвращает CompiledLevel с уже собранным атласом
+        self.request_images()
+        atlas = asset_loader.load(self.atlas_path)
+        level = CompiledLevel(self.level_path, self.atlas_path)
+        level.atlas_image = atlas
+        return level
+
+    def build_atlas(self):
+        # Работа пула: нарезка тайлов в атлас, запись атласа и уровня в кэш. Без перевода в формат экрана —
+        # это делает главный поток (CompiledLevel.load_tile_images). Возвращает атлас
+        os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+        sheets = {path: asset_loader.load(path) for path in self.image_paths}
+        atlas_rows = max(1, (len(self.tile_sources) + ATLAS_COLUMNS - 1) // ATLAS_COLUMNS)
+        atlas = pg.Surface((ATLAS_COLUMNS * self.tilewidth, atlas_rows * self.tileheight), pg.SRCALPHA)
+        for local_id, source in self.tile_sources.items():
+            tile = cut_tile(sheets, source, (self.tilewidth, self.tileheight))
+            index = local_id - 1
+            atlas.blit(tile, (index % ATLAS_COLUMNS * self.tilewidth, index // ATLAS_COLUMNS * self.tileheight))
+        # Атлас — тоже через временный файл и раньше уровня: уровень в кэше всегда лежит рядом с целым атласом
+        with open(self.atlas_path + ".tmp", "wb") as atlas_file:
+            pg.image.save(atlas, atlas_file, self.atlas_path)
+        os.replace(self.atlas_path + ".tmp", self.atlas_path)
+
+        data = bytearray(LEVEL_HEADER.pack(
+            LEVEL_MAGIC, LEVEL_VERSION, self.tmx_mtime, self.enemies_mtime, self.source_hash,
+            self.width, self.height, self.tilewidth, self.tileheight, len(self.layers), len(self.rects),
+            len(self.spawns), len(self.tile_sources), len(self.image_paths)))
+        for name, packed in self.layers:
+            data += LEVEL_LAYER_NAME.pack(name.encode("utf-8"))
+            data += struct.pack(f"<{len(packed)}H", *packed)
+        for rect in self.rects:
+            data += LEVEL_RECT.pack(*rect)
+        for spawn in self.spawns:
+            data += LEVEL_SPAWN.pack(*spawn)
+        for path, mtime in zip(self.image_paths, self.image_mtimes):
+            encoded = path.encode("utf-8")
+            data += LEVEL_IMAGE.pack(mtime, len(encoded)) + encoded
+
+        # Пишем во временный файл и подменяем: недописанный уровень никогда не окажется в кэше
+        with open(self.level_path + ".tmp", "wb") as level_file:
+            level_file.write(data)
+        os.replace(self.level_path + ".tmp", self.level_path)
+        return atlas
+
+
+def cached_level(tmx_path, enemies_path):
+    # Скомпилированный уровень из кэша или None, если кэша нет, он устарел или повреждён
+    level_path, atlas_path = level_cache_paths(tmx_path)
+    if not (os.path.exists(level_path) and os.path.exists(atlas_path)):
+        return None
+    try:
+        level = CompiledLevel(level_path, atlas_path)
+    except (ValueError, struct.error):
+        return None
+    return level if level.is_fresh(tmx_path, enemies_path) else None
+
+
+def load_level(tmx_path, enemies_path, layer_names):
+    # Скомпилированный уровень из кэша; при устаревшем или повреждённом кэше — пересборка
+    level = cached_level(tmx_path, enemies_path)
+    if level is None:
+        level = LevelSource(tmx_path, enemies_path, layer_names).compile()
+    return level
+
+
+# Элемент интерфейса: поверхность перерисовывается, только когда меняется значение
+class HudWidget:
+    def __init__(self, render):
+        self.render = render  # значение -> поверхность
+        self.value = None
+        self.surface = None
+
+    def get(self, value):
+        if self.surface is None or value != self.value:
+            self.surface = prepare_surface(self.render(value))
+            self.value = value
+        return self.surface
+
+
+# Интерфейс поверх уровня, собранный из закэшированных поверхностей
+class Hud:
+    HP_BAR_SIZE = (100, 20)
+    MAX_HP = 10
+
+    def __init__(self):
+        self.hp_bar = HudWidget(self.render_hp_bar)
+        self.coins = HudWidget(lambda coins: font.render(f"Coins: {coins}", True, "black"))
+        self.game_over = HudWidget(lambda mode: font.render("Вы проиграли", True, (255, 0, 0)))
+
+    def render_hp_bar(self, hp):
+        # Полоса здоровья
+        hp_bar_length, hp_bar_height = self.HP_BAR_SIZE
+        surface = pg.Surface(self.HP_BAR_SIZE, pg.SRCALPHA)
+        current_hp_length = max(0, int(hp_bar_length * (hp / self.MAX_HP)))
+        pg.draw.rect(surface, (255, 0, 0), (0, 0, current_hp_length, hp_bar_height))
+        pg.draw.rect(surface, pg.Color("black"), (0, 0, hp_bar_length, hp_bar_height), 2)
+        return surface
+
+    def surfaces(self):
+        # Уже отрисованные поверхности виджетов
+        widgets = (self.hp_bar, self.coins, self.game_over)
+        return [widget.surface for widget in widgets if widget.surface is not None]
+
+    def draw(self, screen, hp, coins, mode):
+        screen.blit(self.hp_bar.get(hp), (10, 10))
+        if mode == "game over":
+            text = self.game_over.get(mode)
+            screen.blit(text, text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)))
+        screen.blit(self.coins.get(coins), (10, 30))
+
+
+def prepare_level(tmx_path, enemies_path, layer_names):
+    # Работа фонового потока: разбор файлов, без единой поверхности pygame.
+    # Возвращает CompiledLevel из кэша или LevelSource, если кэш нужно пересобрать;
+    # картинки для них декодируются в пуле asset_loader (request_images)
+    level = cached_level(tmx_path, enemies_path)
+    if level is None:
+        return LevelSource(tmx_path, enemies_path, layer_names)
+    return level
+
+
+# Подготовка следующего уровня в фоновом потоке, пока игрок проходит текущий
+class LevelPrefetcher:
     def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="level-prefetch")
+        self.futures = {}  # путь к TMX -> Future с результатом prepare_level
+
+    def request(self, tmx_path, enemies_path, layer_names):
+        if tmx_path not in self.futures and os.path.exists(tmx_path):
+            self.futures[tmx_path] = self.executor.submit(prepare_level, tmx_path, enemies_path, layer_names)
+
+    def ready(self, tmx_path):
+        future = self.futures.get(tmx_path)
+        return future is not None and future.done()
+
+    def pending(self, tmx_path):
+        future = self.futures.get(tmx_path)
+        return future is not None and not future.done()
+
+    def peek(self, tmx_path):
+        # Готовый результат подготовки, не забирая его; None — ещё не готов или подготовка упала
+        future = self.futures.get(tmx_path)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def take(self, tmx_path, enemies_path, layer_names):
+        # Готовый уровень из фонового потока. Если подготовка ещё идёт, дожидаемся её,
+        # а если не запускалась или упала — загружаем синхронно.
+        # Если кэш устарел, дожидаемся сборки атласа в пуле (обычно она уже закончилась за экраном загрузки)
+        level = None
+        future = self.futures.pop(tmx_path, None)
+        if future is not None:
+            try:
+                level = future.result()
+            except Exception:
+                pass
+        if level is None:
+            level = prepare_level(tmx_path, enemies_path, layer_names)
+        return level.compile() if isinstance(level, LevelSource) else level
 
-        pygame.mixer.music.play(-1)
+
+class Game:
+    # Конструктор класса Game
+    def __init__(self, headless=HEADLESS):
+        self.headless = headless
+        if not headless:
+            pygame.mixer.music.load(MUSIC_PATH)
+            pygame.mixer.music.set_volume(0.1)
+            pygame.mixer.music.play(-1)
+        # В безголовом режиме экран создаётся на драйвере dummy: он нужен для convert_alpha()
+        # и для замеров отрисовки, но на экран ничего не выводится
         self.screen = pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         pg.display.set_caption("Платформер")
         self.level = 1
@@ -429,152 +1715,322 @@ class Game:
         self.coins_score = 0  # Инициализация монет
         self.camera_x = 0
         self.camera_y = 0
-        self.background_menu = pg.image.load("menu.jpg")
-        self.background_menu = pg.transform.scale(self.background_menu, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        self.sprites_drawn = 0  # Счётчики отсечения за последний кадр
+        self.sprites_culled = 0
+        self.previous_camera = (0, 0)
+        self.previous_positions = {}
+        self.pending_input = 0  # Нажатия с прошлого тика
+        self.controls = 0  # Ввод текущего тика
+        self.recording = None
+        self.replay = None
+        self.replay_position = 0
+        # PLATFORMER_PROFILE — включить замеры с начала и выгрузить их в этот файл при выходе
+        self.profile_path = os.environ.get("PLATFORMER_PROFILE")
+        if self.profile_path:
+            profiler.enabled = True
+        self.background_menu = asset_loader.load("menu.jpg")
+        self.background_menu = prepare_surface(pg.transform.scale(self.background_menu, (SCREEN_WIDTH, SCREEN_HEIGHT)))
+        self.menu_text = prepare_surface(font.render("Нажмите любую клавишу", True, "black"))
+        self.loading_text = prepare_surface(font.render("Загрузка...", True, "black"))
+        self.loading = []  # Картинки, которые декодируются для загружаемого уровня
 
         self.is_play = False
         self.mode = "menu"
+        self.prefetcher = LevelPrefetcher()
+        self.hud = Hud()
+        self.dirty_rendering = DIRTY_RECTS
+        self.last_camera = None  # None — следующий кадр рисуется целиком
+        self.last_placements = {}
+        self.last_hud_state = None
+        self.last_overlay = False  # Был ли на прошлом кадре оверлей профилировщика
 
     def setup(self):
         # Инициализация всех игровых переменных и загрузка уровня
         self.coins_score = 0
         self.is_play = True
         self.mode = "game"
-        self.background = pg.image.load("Background.png")
-        self.background = pg.transform.scale(self.background, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        sim_clock.reset()
+        animation_clock.sync(0)
+        frame_cache.begin_level()
 
         # Создание групп спрайтов
         # Создание групп спрайтов
-        self.all_sprites = pg.sprite.Group()
-        self.platforms = pg.sprite.Group()
+        self.all_sprites = SpatialGroup(256)  # Сетка по спрайтам нужна для отсечения невидимых при отрисовке
+        self.platforms = pg.sprite.Group()  # Прямоугольники столкновений (Collider), без изображений
         self.enemies = pg.sprite.Group()
-        self.balls = pg.sprite.Group()
+        self.balls = BallPool()
         self.coins = pg.sprite.Group()
         self.portals = pg.sprite.Group()
-        self.shipi = pg.sprite.Group()
-
-
-        # Загрузка карты уровня
-        self.tmx_map = pytmx.load_pygame(f"maps/level{self.level}.tmx")
+        self.shipi = SpatialHash(256)  # Шипы проверяются только рядом с игроком
+        # Списки обновления по поведению: статичное в них не попадает, игрок и шары обновляются отдельно
+        self.movers = pg.sprite.Group()  # Враги с физикой и столкновениями с платформами
+        self.dormant = SpatialHash(256)  # Спящие враги далеко от камеры: не обновляются
+        self.sleep_ticks = {}  # спящий враг -> тик, на котором он заснул
+        self.restless = {}  # враг, которому нельзя спать -> y, при котором это проверено
+        self.static_layer = ChunkRenderer()  # Неподвижные тайлы ("Game" и "Shipi") рисуются чанками
+
+
+        # Загрузка карты уровня (из скомпилированного кэша, при необходимости он пересобирается).
+        # Следующий уровень сразу начинает готовиться в фоне
+        self.level_data = self.prefetcher.take(self.level_path(self.level), self.ENEMIES_PATH, self.LAYER_HANDLERS)
         self.load_map()  # Вызов функции загрузки карты
+        self.level_snapshot = self.take_snapshot()
+        asset_loader.discard()
+        self.prefetcher.request(self.level_path(self.level + 1), self.ENEMIES_PATH, self.LAYER_HANDLERS)
 
         self.camera_x = 0
         self.camera_y = 0
         self.camera_speed = 4
+        self.previous_camera = (0, 0)
+        self.previous_positions = {}
+        self.last_camera = None
+
+    # Листы спрайтов, нужные каждому уровню: декодируются заранее, пока показывается экран загрузки
+    LEVEL_IMAGES = (
+        "sprites/Sprite Pack 3/2 - Twiggy/Idle (32 x 32).png",
+        "sprites/Sprite Pack 3/2 - Twiggy/Running (32 x 32).png",
+        "sprites/Sprite Pack 2/9 - Snip Snap Crab/Movement_(Flip_image_back_and_forth) (32 x 32).png",
+        "sprites/Sprite Pack 2/4 - Robo Pumpkin/Standing (16 x 16).png",
+        "sprites/ball.png",
+        "sprites/spr_coin_strip4.png",
+        "sprites/Green Portal Sprite Sheet.png",
+    )
+
+    def open_menu(self):
+        # Меню — такое же состояние главного цикла, как загрузка: рисуется каждый кадр в run(),
+        # а первый уровень тем временем уже готовится в фоне
+        self.mode = "menu"
+        self.request_level()
+
+    def begin_loading(self):
+        # Загрузка уровня без остановки главного цикла: картинки декодируются в пуле потоков,
+        # уровень готовит prefetcher, а спрайты создаёт setup(), когда всё готово (см. run)
+        self.mode = "loading"
+        self.request_level()
+
+    def request_level(self):
+        self.loading = [asset_loader.request(path) for path in self.LEVEL_IMAGES if not frame_cache.has_source(path)]
+        self.prefetcher.request(self.level_path(self.level), self.ENEMIES_PATH, self.LAYER_HANDLERS)
+
+    def loading_progress(self):
+        # (готово, всего): декодированные картинки, сам уровень, а когда он разобран — его атлас
+        # (или листы тайлсетов и сборка атласа, если кэш устарел)
+        futures = list(self.loading)
+        level = self.prefetcher.peek(self.level_path(self.level))
+        if level is not None:
+            futures += level.request_images()
+        done = sum(future.done() for future in futures)
+        done += not self.prefetcher.pending(self.level_path(self.level))
+        return done, len(futures) + 1
+
+    def draw_menu(self):
+        if ASSET_CHECKS:
+            self.check_surfaces([("menu", self.background_menu), ("menu", self.menu_text)])
+        self.screen.blit(self.background_menu, (0, 0))
+        self.screen.blit(self.menu_text, self.menu_text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT * 3 // 4)))
+        with profiler.phase("flip"):
+            pg.display.flip()
+
+    def draw_loading(self):
+        # Экран загрузки: фон меню и полоса прогресса
+        done, total = self.loading_progress()
+        if ASSET_CHECKS:
+            self.check_surfaces([("menu", self.background_menu), ("loading", self.loading_text)])
+        self.screen.blit(self.background_menu, (0, 0))
+        bar = pg.Rect(0, 0, SCREEN_WIDTH // 2, 20)
+        bar.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT * 3 // 4)
+        pg.draw.rect(self.screen, "white", (bar.x, bar.y, bar.width * done // total, bar.height))
+        pg.draw.rect(self.screen, "black", bar, 2)
+        self.screen.blit(self.loading_text, self.loading_text.get_rect(midbottom=(bar.centerx, bar.top - 10)))
+        with profiler.phase("flip"):
+            pg.display.flip()
+
+    # Обработчики слоёв TMX: имя слоя -> метод, который строит объекты слоя.
+    # Метод возвращает (обработано тайлов, создано объектов)
+    LAYER_HANDLERS = {
+        "Game": "load_platforms_layer",
+        "Coins": "load_coins_layer",
+        "Portals": "load_portals_layer",
+        "Shipi": "load_shipi_layer",
+    }
+    ENEMIES_PATH = "maps/level1_enemies.json"
+    HUD_RECT = pg.Rect(0, 0, 260, 70)  # Полоса здоровья и счёт монет
+    DIRTY_MAX_AREA = 0.5  # При большей доле изменившегося экрана — полная перерисовка
+    WAKE_AHEAD = 256  # Полоса (px) за областью активности, где спящих будят заранее
+    WAKES_PER_TICK = 4  # Сколько врагов из этой полосы будить за тик
 
     def load_map(self):
-        # Функция загрузки карты и создания спрайтов на основе данных TMX
-        self.map_pixel_width = self.tmx_map.width * self.tmx_map.tilewidth * TILE_SCALE
-        self.map_pixel_height = self.tmx_map.height * self.tmx_map.tileheight * TILE_SCALE
-
-        load_portal = False
-
-        for layer in self.tmx_map:
-            if layer.name == "Game":
-                # Обработка слоя с платформами
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
-                    if tile:
-                        platform = Platform(tile, x * self.tmx_map.tilewidth, y * self.tmx_map.tileheight,
-                                            self.tmx_map.tilewidth, self.tmx_map.tileheight)
-                        self.all_sprites.add(platform)
-                        self.platforms.add(platform)
-
-                with open("maps/level1_enemies.json", "r") as json_file:
-                    data = json.load(json_file)
-
-                for enemy in data["enemies"]:
-                    if enemy["name"] == "Crab":
-
-                        x1 = enemy["start_pos"][0] * TILE_SCALE * self.tmx_map.tilewidth
-                        y1 = enemy["start_pos"][1] * TILE_SCALE * self.tmx_map.tilewidth
-
-                        x2 = enemy["final_pos"][0] * TILE_SCALE * self.tmx_map.tilewidth
-                        y2 = enemy["final_pos"][1] * TILE_SCALE * self.tmx_map.tilewidth
-
-
-                        crab = Crab(self.map_pixel_width, self.map_pixel_height, [x1, y1], [x2, y2])
-                        self.all_sprites.add(crab)
-                        self.enemies.add(crab)
-
-            elif layer.name == "Coins":
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
-
-                    if tile:
-                        coin = Coin(x * self.tmx_map.tilewidth * TILE_SCALE,
-                                    y * self.tmx_map.tileheight * TILE_SCALE)
-                        self.all_sprites.add(coin)
-                        self.coins.add(coin)
-                self.coins_amount = len(self.coins.sprites())
-
-
-
-            elif layer.name == "Portals":
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
-                    if tile:
-                        portal = Portal(x * self.tmx_map.tilewidth * TILE_SCALE, y * self.tmx_map.tileheight * TILE_SCALE)
-                        self.all_sprites.add(portal)
-                        self.portals.add(portal)
-                        load_portal = True
-                        break
-
-            elif layer.name == "Shipi":
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
-
-                    if tile:
-                        ship = Ship(tile, x * self.tmx_map.tilewidth, y * self.tmx_map.tileheight,
-                                            self.tmx_map.tilewidth,
-                                            self.tmx_map.tileheight)
-                        self.all_sprites.add(ship)
-                        self.shipi.add(ship)
-
-
-
-
-
-        # Создание игрока, врагов и других объектов
+        # Функция создания спрайтов по скомпилированному уровню.
+        # Каждый слой проходится один раз, статистика загрузки остаётся в self.load_stats
+        level = self.level_data
+        self.map_pixel_width = level.width * level.tilewidth * TILE_SCALE
+        self.map_pixel_height = level.height * level.tileheight * TILE_SCALE
+
+        self.tile_images = level.load_tile_images()
+        self.coins_amount = 0
+        self.load_stats = {"tiles": 0, "entities": 0, "ms": 0, "layers": {}}
+
+        for name, layer in level.layers.items():
+            handler = self.LAYER_HANDLERS.get(name)
+            if handler is not None:
+                self.measure_load(name, getattr(self, handler), layer)
+        self.measure_load("enemies", self.load_enemies)
+        self.measure_load("colliders", self.build_colliders)
+
+        # Создание игрока и других объектов
         self.player = Player(self.map_pixel_width, self.map_pixel_height)
         self.all_sprites.add(self.player)
 
-        self.crab = Crab(self.map_pixel_width, self.map_pixel_height)
-
-        self.all_sprites.add(self.crab)
-        self.enemies.add(self.crab)
-
         self.pumpkin = Pumpkin(self.map_pixel_width, self.map_pixel_height)
         self.all_sprites.add(self.pumpkin)
         self.enemies.add(self.pumpkin)
+        self.movers.add(self.pumpkin)
+        self.load_stats["entities"] += 2
 
-        for layer in self.tmx_map:
-            if layer.name == "Game":
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
-
-                    if tile:
-                        platform = Platform(tile, x * self.tmx_map.tilewidth, y * self.tmx_map.tileheight,
-                                            self.tmx_map.tilewidth,
-                                            self.tmx_map.tileheight)
-                        self.all_sprites.add(platform)
-                        self.platforms.add(platform)
-
-            elif layer.name == "Coins":
-                for x, y, gid in layer:
-                    tile = self.tmx_map.get_tile_image_by_gid(gid)
+        self.camera_x = 0
+        self.camera_y = 0
+        self.camera_speed = 4
 
-                    if tile:
-                        coin = Coin(x * self.tmx_map.tilewidth * TILE_SCALE, y * self.tmx_map.tileheight * TILE_SCALE)
+    def take_snapshot(self):
+        # Начальное состояние уровня: для каждого спрайта — его группы и копия атрибутов
+        snapshot = []
+        for sprite in self.all_sprites:
+            state = {name: value.copy() if isinstance(value, pg.Rect) else value
+                     for name, value in entity_state(sprite).items()}
+            snapshot.append((sprite, sprite.groups(), state))
+        return snapshot
 
-                        self.all_sprites.add(coin)
-                        self.coins.add(coin)
+    def restart(self):
+        # Быстрый перезапуск уровня без загрузки ресурсов: спрайты возвращаются в состояние из снимка
+        self.coins_score = 0
+        self.mode = "game"
+        sim_clock.reset()
+        animation_clock.sync(0)
+        for sprite in self.all_sprites.sprites():
+            sprite.kill()
+        self.balls.clear()
+        self.dormant = SpatialHash(256)
+        self.sleep_ticks = {}
+        self.restless = {}
+        if self.enemy_swarm is not None:
+            self.enemy_swarm.reset()
+        for sprite, groups, state in self.level_snapshot:
+            for name, value in state.items():
+                setattr(sprite, name, value.copy() if isinstance(value, pg.Rect) else value)
+            sprite.add(*groups)
 
         self.camera_x = 0
         self.camera_y = 0
-        self.camera_speed = 4
-
-        self.run()
+        self.previous_camera = (0, 0)
+        self.previous_positions = {}
+        self.last_camera = None
+
+    def measure_load(self, name, handler, *args):
+        start = time.perf_counter()
+        tiles, entities = handler(*args)
+        ms = (time.perf_counter() - start) * 1000
+        self.load_stats["layers"][name] = {"tiles": tiles, "entities": entities, "ms": ms}
+        self.load_stats["tiles"] += tiles
+        self.load_stats["entities"] += entities
+        self.load_stats["ms"] += ms
+
+    def level_path(self, level):
+        return f"maps/level{level}.tmx"
+
+    def layer_tiles(self, layer):
+        # Непустые клетки слоя: (x, y, номер тайла) в тайлах
+        width = self.level_data.width
+        for index, tile_id in enumerate(layer):
+            if tile_id:
+                yield index % width, index // width, tile_id
+
+    def load_platforms_layer(self, layer):
+        # Видимые тайлы уходят в чанки; прямоугольники столкновений уже посчитаны при компиляции
+        tile_width = self.level_data.tilewidth * TILE_SCALE
+        tile_height = self.level_data.tileheight * TILE_SCALE
+        scaled_tile_images = self.level_data.scaled_tile_images
+        tiles = 0
+        for x, y, tile_id in self.layer_tiles(layer):
+            self.static_layer.add(scaled_tile_images[tile_id], pg.Rect(x * tile_width, y * tile_height,
+                                                                       tile_width, tile_height))
+            tiles += 1
+        return tiles, 0
+
+    def load_coins_layer(self, layer):
+        tiles = 0
+        for x, y, tile_id in self.layer_tiles(layer):
+            coin = Coin(x * self.level_data.tilewidth * TILE_SCALE, y * self.level_data.tileheight * TILE_SCALE)
+            self.all_sprites.add(coin)
+            self.coins.add(coin)
+            tiles += 1
+        self.coins_amount = len(self.coins)
+        return tiles, tiles
+
+    def load_portals_layer(self, layer):
+        # На уровне один портал — берём первый тайл слоя
+        for x, y, tile_id in self.layer_tiles(layer):
+            portal = Portal(x * self.level_data.tilewidth * TILE_SCALE, y * self.level_data.tileheight * TILE_SCALE)
+            self.all_sprites.add(portal)
+            self.portals.add(portal)
+            return 1, 1
+        return 0, 0
+
+    def load_shipi_layer(self, layer):
+        scaled_tile_images = self.level_data.scaled_tile_images
+        masks = {}  # номер тайла -> маска, одна на все шипы этого тайла
+        tiles = 0
+        for x, y, tile_id in self.layer_tiles(layer):
+            mask = masks.get(tile_id)
+            if mask is None:
+                mask = masks[tile_id] = pg.mask.from_surface(scaled_tile_images[tile_id])
+            ship = Ship(mask, x * self.level_data.tilewidth, y * self.level_data.tileheight,
+                        self.level_data.tilewidth, self.level_data.tileheight)
+            self.static_layer.add(scaled_tile_images[tile_id], ship.rect)
+            self.shipi.insert(ship, ship.rect)
+            tiles += 1
+        return tiles, tiles
+
+    def load_enemies(self):
+        # Таблица врагов из скомпилированного уровня (исходно — ENEMIES_PATH)
+        tile_size = TILE_SCALE * self.level_data.tilewidth
+        entities = 0
+        for name, start_pos, final_pos in self.level_data.spawns:
+            if name == "Crab":
+                x1 = start_pos[0] * tile_size
+                y1 = start_pos[1] * tile_size
+
+                x2 = final_pos[0] * tile_size
+                y2 = final_pos[1] * tile_size
+
+                crab = Crab(self.map_pixel_width, self.map_pixel_height, [x1, y1], [x2, y2])
+                self.all_sprites.add(crab)
+                self.enemies.add(crab)
+                self.movers.add(crab)
+                entities += 1
+        return 0, entities
+
+    def build_colliders(self):
+        # Прямоугольники столкновений, объединённые из соседних твёрдых тайлов при компиляции:
+        # число проверок зависит от числа поверхностей, а не тайлов
+        rects = self.level_data.rects if MERGED_COLLIDERS else split_merged_tiles(self.level_data.rects)
+        for x, y, width, height in rects:
+            collider = Collider(x * self.level_data.tilewidth, y * self.level_data.tileheight,
+                                width * self.level_data.tilewidth, height * self.level_data.tileheight)
+            self.platforms.add(collider)
+
+        # Статический индекс прямоугольников столкновений для проверок
+        self.platform_index = SpatialHash(max(self.level_data.tilewidth, self.level_data.tileheight) * TILE_SCALE * 2)
+        for platform in self.platforms:
+            self.platform_index.insert(platform, platform.rect)
+
+        # Та же раскладка по тайлам для векторных проверок (враги, шары), если есть NumPy
+        self.collider_grid = None
+        if np is not None:
+            self.collider_grid = ColliderGrid(self.platforms, self.level_data.tilewidth * TILE_SCALE,
+                                              self.level_data.tileheight * TILE_SCALE,
+                                              self.level_data.width, self.level_data.height)
+        self.enemy_swarm = EnemySwarm(self.collider_grid) if BATCHED_ENEMIES else None
+        return 0, len(self.platforms)
 
     def event(self):
         # Обработка игровых событий (нажатий клавиш, выхода из игры и т.д.)
@@ -585,28 +2041,82 @@ class Game:
             if event.type == pg.QUIT:
                 self.is_running = False
 
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                profiler.enabled = True
+                profiler.show_overlay = not profiler.show_overlay
+                continue
+            if event.type == pg.KEYDOWN and event.key == pg.K_F4:
+                profiler.dump(self.profile_path or FrameProfiler.DUMP_PATH)
+                continue
+
             if event.type == pg.KEYDOWN:
+                # Нажатия копятся до ближайшего тика и обрабатываются в apply_input
+                self.pending_input |= INPUT_ANY_KEY
                 if event.key == pg.K_RETURN:
-                    if self.player.current_animation in (
-                            self.player.idle_animation_right, self.player.move_animation_right):
-                        direction = "right"
-                    else:
-                        direction = "left"
-                    ball = Ball(self.player.rect, direction)
-                    self.balls.add(ball)
-                    self.all_sprites.add(ball)
-
-            if self.mode == "game over":
-                if event.type == pg.KEYDOWN:
-                    self.setup()
-            if event.type == pg.MOUSEBUTTONDOWN:
-                # если игра не идёт, при клике переход в меню
-                if not self.is_play and self.mode == "play":
-                    if event.button == 1:
-                        self.mode = "menu"
+                    self.pending_input |= INPUT_FIRE
+
+            if self.mode == "menu" and event.type in (pg.KEYDOWN, pg.MOUSEBUTTONDOWN):
+                # Из меню — в игру: уровень догружается за экраном загрузки
+                self.begin_loading()
+
+    def read_input(self):
+        # Ввод для следующего тика: из записи при воспроизведении, иначе с клавиатуры
+        if self.replay is not None:
+            self.pending_input = 0
+            if self.replay_position >= len(self.replay):
+                self.is_running = False
+                return None
+            controls = self.replay[self.replay_position]
+            self.replay_position += 1
+            if self.replay_position == len(self.replay):
+                self.is_running = False  # Запись закончилась: это последний тик
+        else:
+            controls = read_keyboard() | self.pending_input
+            self.pending_input = 0
+        if self.recording is not None:
+            self.recording.append(controls)
+        return controls
+
+    def apply_input(self, controls):
+        if controls & INPUT_FIRE:
+            if self.player.current_animation in (
+                    self.player.idle_animation_right, self.player.move_animation_right):
+                direction = "right"
+            else:
+                direction = "left"
+            self.balls.spawn(self.player.rect, direction)
+
+        if self.mode == "game over":
+            if controls & INPUT_ANY_KEY:
+                self.restart()
+
+    def step(self):
+        # Один тик симуляции: ввод, обновление, продвижение часов симуляции
+        controls = self.read_input()
+        if controls is None:
+            return
+        self.controls = controls
+        self.save_positions()
+        self.apply_input(controls)
+        self.update()
+        sim_clock.advance()
+
+    def start_recording(self, path):
+        # Вызывать сразу после setup(): запись воспроизводится с начала уровня
+        self.recording = bytearray()
+        self.recording_path = path
+        self.recording_level = self.level
+
+    def stop_recording(self):
+        if self.recording is not None:
+            save_input_log(self.recording_path, self.recording_level, self.recording)
+            self.recording = None
+
+    def start_replay(self, path):
+        self.level, self.replay = load_input_log(path)
+        self.replay_position = 0
+        self.setup()
 
-            if self.mode == "menu":
-                self.is_play = True
     def update_camera(self):
         target_x = self.player.rect.centerx - SCREEN_WIDTH // 2
         target_y = self.player.rect.centery - SCREEN_HEIGHT // 2
@@ -617,47 +2127,48 @@ class Game:
 
 
     def update(self):
-        if self.mode == "menu":
-            self.is_play = True
-            print("menu")
-            mouse_pos = pg.mouse.get_pos()
-
-            # for song in Song.songs:
-            #     if song.rect.collidepoint(mouse_pos):
-            #         song.color = "green"
-            #     else:
-            #         song.color = "red"
-
-            while True:
-
-                # место для отрисовки меню
-                self.screen.blit(self.background_menu, (0, 0))
+        # Меню и экран загрузки тиков не получают: их рисует run() (draw_menu, draw_loading)
         if self.mode == "game":
 
             if self.player.hp <= 0:
                 self.mode = "game over"
                 return
 
-            for sprite in self.all_sprites:
-                if isinstance(sprite, Player) or isinstance(sprite, Crab):
-                    sprite.update(platforms=self.platforms)
-                else:
-                    sprite.update()
-
-            for enemy in self.enemies.sprites():
+            # Системы обновления по поведению: каждая перебирает только свою группу, статичное не трогается.
+            # Объекты разных систем друг от друга не зависят, поэтому порядок систем не важен.
+            # Кадры анимации (монеты, порталы, враги, игрок) считаются из общих часов, отдельной системы им не нужно
+            animation_clock.sync(sim_clock.tick)
+            with profiler.phase("update:activation"):
+                self.update_activation()
+            with profiler.phase("update:Player"):
+                self.player.update(platforms=self.platform_index, controls=self.controls)
+            with profiler.phase("update:movers"):
+                self.update_movers()
+            with profiler.phase("update:Ball"):
+                self.balls.update()
+
+            # Перекладываем подвижные спрайты в сетке отрисовки
+            self.all_sprites.refresh(self.player)
+            for sprite in self.movers:
+                self.all_sprites.refresh(sprite)
+
+            collisions_start = time.perf_counter()
+            # Сначала дешёвая проверка прямоугольников, маски — только для пересёкшихся
+            for enemy in pg.sprite.spritecollide(self.player, self.enemies, False):
                 if pg.sprite.collide_mask(self.player, enemy):
                     self.player.get_damage()
 
-            for ship in self.shipi.sprites():
-                if pg.sprite.collide_mask(self.player, ship):
+            for ship in self.shipi.query(self.player.rect):
+                if self.player.rect.colliderect(ship.rect) and pg.sprite.collide_mask(self.player, ship):
                     self.player.get_damage()
 
-            pg.sprite.groupcollide(self.balls, self.enemies, True, True)
-            pg.sprite.groupcollide(self.balls, self.platforms, True, False)
+            self.balls.collide(self.enemies, self.all_sprites.index, self.platform_index, self.collider_grid)
 
 
             coins_collected = pg.sprite.spritecollide(self.player, self.coins, True)
-            portals_collected = pg.sprite.spritecollide(self.player, self.portals, False, pg.sprite.collide_mask)
+            portals_collected = [portal for portal in pg.sprite.spritecollide(self.player, self.portals, False)
+                                 if pg.sprite.collide_mask(self.player, portal)]
+            profiler.add("collisions", time.perf_counter() - collisions_start)
 
             if coins_collected:
                 self.coins_score += 1  # Добавляем по очку за каждую собранную монету
@@ -665,43 +2176,279 @@ class Game:
             if portals_collected and self.coins_score > self.coins_amount // 2:
                 self.level += 1
                 if self.level == 4:
-                    quit()
-                self.setup()
+                    self.is_running = False
+                    return
+                self.begin_loading()
+                return
             self.update_camera()
 
 
-    def draw(self):
-        self.screen.fill("light blue")
-        for sprite in self.all_sprites:
-            self.screen.blit(sprite.image, sprite.rect.move(-self.camera_x, -self.camera_y))
-
-        # Отрисовка полосы здоровья
-        hp_bar_length = 100
-        hp_bar_height = 20
-        current_hp_length = hp_bar_length * (self.player.hp / 10)  # HP = 10
-        hp_bar_color = (255, 0, 0)
-        pg.draw.rect(self.screen, hp_bar_color, (10, 10, current_hp_length, hp_bar_height))
-        pg.draw.rect(self.screen, pg.Color("black"), (10, 10, hp_bar_length, hp_bar_height), 2)
-
-        if self.mode == "game over":
-            text = font.render("Вы проиграли", True, (255, 0, 0))
-            text_rect = text.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-            self.screen.blit(text, text_rect)
-
-        coins_score_text = font.render(f"Coins: {self.coins_score}", True, "black")
-        self.screen.blit(coins_score_text, (10, 30))
-        pg.display.flip()  # Обновление экрана с новым кадром
+    def update_activation(self):
+        # Враги дальше ACTIVATION_MARGIN от камеры засыпают: уходят из movers в отдельную сетку
+        # и не обновляются. Будятся те, кто мог за время сна дойти до области вокруг камеры
+        # или попасть под шар этого тика, и догоняют пропущенные тики (Crab.catch_up),
+        # так что цена тика зависит от окрестности игрока, а симуляция — нет
+        if ACTIVATION_MARGIN < 0:
+            return
+        region = pg.Rect(round(self.camera_x), round(self.camera_y), SCREEN_WIDTH, SCREEN_HEIGHT)
+        region.inflate_ip(2 * ACTIVATION_MARGIN, 2 * ACTIVATION_MARGIN)
+        # Куда за этот тик долетят шары: rect шара, расширенный на его шаг в обе стороны
+        width, height = BallPool.BALL_SIZE
+        speed = BallPool.BALL_SPEED
+        areas = [region] + [pg.Rect(x - speed, y, width + 2 * speed, height)
+                            for key, (x, y) in self.balls.positions()]
+        for area in areas:
+            for sprite in self.dormant.query(area):
+                if self.sleep_bounds(sprite).colliderect(area):
+                    self.wake(sprite)
+        # Полоса WAKE_AHEAD вокруг области: отсюда будим заранее, не больше WAKES_PER_TICK за тик,
+        # чтобы камера, въехавшая в толпу спящих, не будила их всех на одном тике. Засыпают
+        # только за этой полосой, поэтому разбуженный заранее враг не засыпает снова
+        ahead = region.inflate(2 * self.WAKE_AHEAD, 2 * self.WAKE_AHEAD)
+        early = [sprite for sprite in self.dormant.query(ahead) if self.sleep_bounds(sprite).colliderect(ahead)]
+        for sprite in early[:self.WAKES_PER_TICK]:
+            self.wake(sprite)
+        areas[0] = ahead
+        # Засыпает только тот, чей путь догоняется в замкнутом виде; остальные (упираются в стены,
+        # доходят до края платформы) бодрствуют. Пока y тот же, путь тот же — повторно не проверяем
+        sleepy = [sprite for sprite in self.movers.sprites()
+                  if self.restless.get(sprite) != sprite.rect.y and self.sleep_bounds(sprite).collidelist(areas) < 0]
+        if sleepy and self.enemy_swarm is not None:
+            self.enemy_swarm.sync()  # Направление и скорость пакетных врагов — из массивов
+        for sprite in sleepy:
+            if not sprite.can_catch_up(self.platform_index, self.map_pixel_height):
+                self.restless[sprite] = sprite.rect.y
+                continue
+            self.restless.pop(sprite, None)
+            self.movers.remove(sprite)
+            self.dormant.insert(sprite, self.sleep_bounds(sprite))
+            self.sleep_ticks[sprite] = sim_clock.tick
+
+    def wake(self, sprite):
+        self.dormant.remove(sprite)
+        ticks = sim_clock.tick - self.sleep_ticks.pop(sprite)
+        if sprite.alive():
+            sprite.catch_up(ticks, self.platform_index)
+            self.movers.add(sprite)
+
+    def sleep_bounds(self, sprite):
+        # Где враг может оказаться за время сна: по горизонтали — между границами патруля
+        # с запасом на шаги после разворота, по вертикали — на всю высоту карты
+        # (с края платформы он может упасть, на ступеньку — подняться)
+        margin = 2 * sprite.CRAB_MOVE_SPEED
+        left = min(sprite.left_edge, sprite.rect.left) - margin
+        right = max(sprite.right_edge, sprite.rect.right) + margin
+        return pg.Rect(left, 0, right - left, self.map_pixel_height)
+
+    def update_movers(self):
+        # Патрулирующие враги обновляются пакетом (если есть NumPy), остальные — по одному
+        tracked = ()
+        if self.enemy_swarm is not None:
+            self.enemy_swarm.update(self.movers, self.platform_index)
+            tracked = self.enemy_swarm.tracked
+        for sprite in self.movers:
+            if sprite not in tracked:
+                sprite.update(platforms=self.platform_index)
+
+    def save_positions(self):
+        # Положения подвижных объектов до тика — для интерполяции при отрисовке
+        self.previous_camera = (self.camera_x, self.camera_y)
+        self.previous_positions = {self.player: self.player.rect.topleft}
+        for sprite in self.movers:
+            self.previous_positions[sprite] = sprite.rect.topleft
+        for key, position in self.balls.positions():
+            self.previous_positions[key] = position
+
+    def draw(self, alpha=1.0):
+        # alpha — доля тика, прошедшая после последнего шага симуляции
+        draw_start = time.perf_counter()
+        previous_camera_x, previous_camera_y = self.previous_camera
+        camera_x = round(previous_camera_x + (self.camera_x - previous_camera_x) * alpha)
+        camera_y = round(previous_camera_y + (self.camera_y - previous_camera_y) * alpha)
+
+        # Рисуем только спрайты, попавшие в камеру (запас на интерполяцию внутри тика)
+        margin = 2 * abs(JUMP_SPEED)
+        view_rect = pg.Rect(camera_x, camera_y, SCREEN_WIDTH, SCREEN_HEIGHT).inflate(margin, margin)
+        visible_sprites = self.all_sprites.visible(view_rect)
+        placements = {}  # спрайт (или ключ шара из пула) -> (изображение, прямоугольник на экране)
+        visible = [(sprite, sprite.image, sprite.rect.topleft) for sprite in visible_sprites]
+        visible += [(key, self.balls.image, position) for key, position in self.balls.visible(view_rect)]
+        for key, image, (x, y) in visible:
+            previous = self.previous_positions.get(key)
+            if previous is not None:
+                x = round(previous[0] + (x - previous[0]) * alpha)
+                y = round(previous[1] + (y - previous[1]) * alpha)
+            placements[key] = (image, image.get_rect(topleft=(x - camera_x, y - camera_y)))
+        self.sprites_drawn = len(placements)
+        self.sprites_culled = len(self.all_sprites) + len(self.balls) - self.sprites_drawn
+        profiler.count("sprites_drawn", self.sprites_drawn)
+        profiler.count("sprites_culled", self.sprites_culled)
+
+        hud_state = (self.player.hp, self.coins_score, self.mode)
+        dirty_rects = None
+        # Оверлей рисуется поверх всего: пока он виден и на первом кадре после его выключения — только целиком
+        overlay = profiler.show_overlay
+        if self.dirty_rendering and (camera_x, camera_y) == self.last_camera and not (overlay or self.last_overlay):
+            dirty_rects = self.dirty_regions(placements, hud_state)
+
+        if dirty_rects is None:
+            # Полная перерисовка: камера сдвинулась или изменилось слишком много
+            self.draw_scene(camera_x, camera_y, placements)
+            if overlay:
+                profiler.draw(self.screen)
+            profiler.add("draw", time.perf_counter() - draw_start)
+            with profiler.phase("flip"):
+                pg.display.flip()  # Обновление экрана с новым кадром
+        else:
+            # Перерисовываем и отправляем на экран только изменившиеся области
+            for rect in dirty_rects:
+                self.screen.set_clip(rect)
+                self.draw_scene(camera_x, camera_y, placements, rect)
+            self.screen.set_clip(None)
+            profiler.add("draw", time.perf_counter() - draw_start)
+            with profiler.phase("flip"):
+                pg.display.update(dirty_rects)
+
+        if ASSET_CHECKS:
+            self.check_surfaces(self.frame_surfaces(visible_sprites))
+
+        self.last_camera = (camera_x, camera_y)
+        self.last_placements = placements
+        self.last_hud_state = hud_state
+        self.last_overlay = overlay
+
+    def draw_scene(self, camera_x, camera_y, placements, area=None):
+        # Фон, статичные чанки, спрайты и интерфейс; area — ограничить отрисовку этой областью экрана
+        self.screen.fill("light blue", area)
+        self.static_layer.draw(self.screen, camera_x, camera_y)
+        for image, rect in placements.values():
+            if area is None or rect.colliderect(area):
+                self.screen.blit(image, rect)
+        self.draw_hud()
+
+    def draw_hud(self):
+        self.hud.draw(self.screen, self.player.hp, self.coins_score, self.mode)
+
+    def dirty_regions(self, placements, hud_state):
+        # Как в LayeredDirty: грязная область спрайта — объединение старого и нового места,
+        # если у него сменилось положение или кадр. None — проще перерисовать экран целиком
+        if hud_state[2] != self.last_hud_state[2]:
+            return None
+        rects = []
+        for sprite, (image, rect) in placements.items():
+            previous = self.last_placements.get(sprite)
+            if previous is None:
+                rects.append(rect)
+            elif previous[0] is not image or previous[1] != rect:
+                rects.append(previous[1].union(rect))
+        for sprite, (image, rect) in self.last_placements.items():
+            if sprite not in placements:
+                rects.append(rect)
+        if hud_state != self.last_hud_state:
+            rects.append(self.HUD_RECT)
+
+        screen_rect = self.screen.get_rect()
+        rects = [rect.clip(screen_rect) for rect in rects]
+        rects = [rect for rect in rects if rect.width and rect.height]
+        if sum(rect.width * rect.height for rect in rects) > screen_rect.width * screen_rect.height * self.DIRTY_MAX_AREA:
+            return None
+        return rects
+
+    def frame_surfaces(self, sprites):
+        # Всё, что кадр уровня выводит на экран: (чьё, поверхность)
+        surfaces = [(type(sprite).__name__, sprite.image) for sprite in sprites]
+        surfaces.append(("BallPool", self.balls.image))
+        surfaces += [("ChunkRenderer", chunk) for chunk in self.static_layer.chunks.values()]
+        surfaces += [("Hud", surface) for surface in self.hud.surfaces()]
+        surfaces += [("FrameProfiler", surface) for surface in profiler.overlay]
+        return surfaces
+
+    def check_surfaces(self, surfaces):
+        formats = display_formats()
+        for owner, surface in surfaces:
+            if not is_display_format(surface, formats):
+                raise RuntimeError(f"{owner}: изображение не переведено в формат экрана "
+                                   f"(нужно пропустить через prepare_surface)")
+
+    def simulate(self, ticks):
+        # Прогон симуляции без отрисовки и без ожидания таймера.
+        # Возвращает число выполненных тиков (меньше ticks, если игра закончилась раньше)
+        for tick in range(ticks):
+            if self.mode == "loading":
+                self.setup()  # Показывать загрузку некому: setup() сам дождётся фоновой подготовки
+            if not self.is_running or (self.mode != "game" and self.replay is None):
+                return tick
+            pg.event.pump()
+            profiler.begin_frame()
+            self.step()
+            profiler.end_frame()
+        return ticks
 
     def run(self):
-        # Основной игровой цикл
+        # Основной игровой цикл: симуляция фиксированными тиками, отрисовка — сколько успеваем.
+        # Если отрисовка не успевает, пропускаются кадры, а не тики симуляции
+        accumulator = 0
+        previous_time = pg.time.get_ticks()
         while self.is_running:
-            self.event()  # Обработка ввода
-            self.update()  # Обновление состояния игры
-            self.draw()  # Отрисовка кадра
+            now = pg.time.get_ticks()
+            accumulator += min(now - previous_time, MAX_FRAME_TIME)
+            previous_time = now
+
+            profiler.begin_frame()
+            with profiler.phase("event"):
+                self.event()  # Обработка ввода
+            if self.mode == "loading":
+                done, total = self.loading_progress()
+                if done == total:
+                    self.setup()
+                    self.pending_input = 0  # Нажатия на экране загрузки в игру не попадают
+            if self.mode == "menu":
+                # Меню и экран загрузки рисуются с полной частотой, а тики симуляции не копятся
+                accumulator = 0
+                self.draw_menu()
+            elif self.mode == "loading":
+                accumulator = 0
+                self.draw_loading()
+            else:
+                while accumulator >= TICK_MS:
+                    self.step()  # Ввод и обновление состояния игры на один тик
+                    accumulator -= TICK_MS
+                    if not self.is_running or self.mode not in ("game", "game over"):
+                        # Уровень пройден или игра закончена: оставшиеся тики кадра не читают ввод
+                        # и не двигают старый уровень — иначе запись разошлась бы с simulate()
+                        break
+                self.draw(accumulator / TICK_MS)  # Отрисовка кадра с интерполяцией между тиками
+            profiler.end_frame()
             self.clock.tick(FPS)
+        self.stop_recording()
+        if self.profile_path:
+            profiler.dump(self.profile_path)
         pg.quit()
         quit()
 
 
 if __name__ == "__main__":
     game = Game()
+    # PLATFORMER_REPLAY — воспроизвести запись ввода (в безголовом режиме — на максимальной скорости),
+    # PLATFORMER_RECORD — записать ввод в файл
+    if os.environ.get("PLATFORMER_REPLAY"):
+        game.start_replay(os.environ["PLATFORMER_REPLAY"])
+    elif game.headless:
+        game.setup()
+    else:
+        game.open_menu()
+    if os.environ.get("PLATFORMER_RECORD"):
+        game.start_recording(os.environ["PLATFORMER_RECORD"])
+    if game.headless:
+        default_ticks = len(game.replay) if game.replay is not None else 10000
+        ticks = game.simulate(int(os.environ.get("PLATFORMER_TICKS", default_ticks)))
+        game.stop_recording()
+        if game.profile_path:
+            profiler.dump(game.profile_path)
+        print(f"ticks: {ticks}, level: {game.level}, hp: {game.player.hp}, coins: {game.coins_score}")
+        print(f"load: {game.load_stats['tiles']} tiles, {game.load_stats['entities']} entities, "
+              f"{game.load_stats['ms']:.1f} ms")
+        for name, stats in game.load_stats["layers"].items():
+            print(f"  {name}: {stats['tiles']} tiles, {stats['entities']} entities, {stats['ms']:.1f} ms")
+    else:
+        game.run()